@@ -0,0 +1,144 @@
+import threading
+import logging
+from collections import deque
+from time import monotonic
+
+
+# Status codes that mean the server wants us to slow down
+BACK_OFF_CODES = (429, 502, 503, 504)
+
+
+# Class for an AIMD (additive increase, multiplicative decrease) limit on concurrent requests, shared between threads.
+# The limit grows while latency stays near its baseline (so throughput is still climbing), holds when latency rises
+# (requests are queueing at the server), and is cut multiplicatively on throttling codes, timeouts and connection
+# errors.
+class AIMDLimiter:
+
+    def __init__(self,
+                 initial_limit=5,
+                 min_limit=1,
+                 max_limit=64,
+                 increase=1,
+                 decrease=0.5,
+                 latency_tolerance=1.5,
+                 latency_drift=0.01,
+                 goodput_window=10):
+
+        # Current (fractional) limit on concurrent requests
+        self.limit_value = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        # Increase per limit's worth of good responses (i.e. about once per round trip at the current limit)
+        self.increase = increase
+        # Factor to cut the limit by when backing off
+        self.decrease = decrease
+        # Latency (relative to the baseline) above which the limit stops increasing
+        self.latency_tolerance = latency_tolerance
+        # Fraction the baseline latency drifts up per response (so it follows a slower server)
+        self.latency_drift = latency_drift
+        # Baseline (near minimum) latency of good responses
+        self.latency_baseline = None
+        # Requests in flight
+        self.in_flight = 0
+        # Time of the last cut (only one cut per round trip, however many requests fail together)
+        self.last_decrease = 0
+        # Window (seconds) for the observed goodput, and the (time, bytes) of good responses in it
+        self.goodput_window = goodput_window
+        self.good_responses = deque()
+        # Condition for waiting on a slot
+        self.condition = threading.Condition()
+
+    # Get the current limit on concurrent requests
+    @property
+    def limit(self):
+        return max(self.min_limit, int(self.limit_value))
+
+    # Wait for a slot under the limit, returning the start time of the request
+    def acquire(self):
+        with self.condition:
+            # Wait until there is room under the limit
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            # Take the slot
+            self.in_flight += 1
+        # Return the start time
+        return monotonic()
+
+    # Release a slot, recording the outcome of the request (back_off for throttling, timeouts and connection errors,
+    # succeeded for a good response; anything else, e.g. a failed validation, does not move the limit). The latency
+    # is the time to the response headers (by default, the time since start_time), so a long transfer of a large
+    # body does not look like queueing at the server.
+    def release(self, start_time, back_off=False, succeeded=True, n_bytes=0, latency=None):
+        # Time now and the latency of the request
+        now = monotonic()
+        if latency is None:
+            latency = now - start_time
+        with self.condition:
+            # Free the slot
+            self.in_flight -= 1
+            # If the server wants us to slow down
+            if back_off:
+                # If the last cut was more than a round trip ago
+                if now - self.last_decrease > (self.latency_baseline or latency):
+                    # Cut the limit
+                    self.limit_value = max(self.min_limit, self.limit_value * self.decrease)
+                    self.last_decrease = now
+                    # Log the info
+                    logging.info(f'Backing off: concurrency limit cut to {self.limit}.')
+            # Otherwise, if the response was good
+            elif succeeded:
+                # Record it for the goodput
+                self.good_responses.append((now, n_bytes))
+                # Update the baseline latency (the minimum, drifting up slowly)
+                if self.latency_baseline is None or latency < self.latency_baseline:
+                    self.latency_baseline = latency
+                else:
+                    self.latency_baseline *= 1 + self.latency_drift
+                # If latency is flat (the server is not queueing our requests)
+                if latency <= self.latency_baseline * self.latency_tolerance:
+                    # Increase the limit
+                    self.limit_value = min(self.max_limit, self.limit_value + self.increase / self.limit_value)
+            # Wake waiting threads (the limit may have grown)
+            self.condition.notify_all()
+
+    # Get the observed goodput over the window as a tuple of (good responses per second, bytes per second)
+    def get_goodput(self):
+        with self.condition:
+            # Start of the window
+            window_start = monotonic() - self.goodput_window
+            # Drop responses from before the window
+            while self.good_responses and self.good_responses[0][0] < window_start:
+                self.good_responses.popleft()
+            # Return the rates
+            return (len(self.good_responses) / self.goodput_window,
+                    sum(n_bytes for response_time, n_bytes in self.good_responses) / self.goodput_window)
+
+    # Get a dictionary of the limiter's state (for logging)
+    def get_stats(self):
+        # Get the goodput
+        requests_per_second, bytes_per_second = self.get_goodput()
+        # Return the stats
+        return {'Limit': self.limit,
+                'In Flight': self.in_flight,
+                'Latency Baseline': self.latency_baseline,
+                'Goodput (requests/s)': requests_per_second,
+                'Goodput (bytes/s)': bytes_per_second}
+
+
+# Shared limiter for LAADS requests in the process
+laads_limiter = None
+# Lock for creating the shared limiter
+laads_limiter_lock = threading.Lock()
+
+
+# Get the shared limiter for LAADS requests in the process (used by downloads; catalog crawls are bounded by their
+# level workers or semaphores instead)
+def get_laads_limiter():
+    global laads_limiter
+    with laads_limiter_lock:
+        # If there is no limiter yet
+        if laads_limiter is None:
+            # Create it
+            laads_limiter = AIMDLimiter()
+    # Return the limiter
+    return laads_limiter
@@ -1,18 +1,35 @@
 import logging
-import json
 import datetime
+import asyncio
+import re
 import t_spinup
 import t_misc
 import t_laads
 import t_requests
-from os import environ, walk, mkdir
+import t_laads_async
+import t_hdf
+import c_laads_store
+import c_aimd_limiter
+from os import environ, mkdir, remove, scandir
 from os.path import exists
 from pathlib import Path
 from time import time
 from dotenv import load_dotenv
+import numpy as np
 from numpy import around
 from shutil import rmtree
-from concurrent.futures import as_completed
+from collections.abc import Mapping
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Default concurrent requests for each level of a catalog crawl (year listings, DOY listings)
+CRAWL_LEVEL_WORKERS = {'year': 4, 'doy': 12}
+# Default concurrent requests for each level of a catalog crawl with the asynchronous engine (adding up to no more
+# than the session's connection limit, t_laads_async.MAX_CONNECTIONS, so no request waits for a connection while its
+# timeout runs)
+ASYNC_CRAWL_LEVEL_WORKERS = {'year': 20, 'doy': 180}
+# Default concurrent downloads
+DOWNLOAD_WORKERS = 5
 
 
 # Class LAADS data set (to load when you need it)
@@ -25,7 +42,9 @@ class LAADSDataSet:
                  start_date=None,
                  end_date=None,
                  include=None,
-                 exclude=None):
+                 exclude=None,
+                 update=False,
+                 crawl=True):
 
         self.name = name
         self.archive_set = archive_set
@@ -35,8 +54,20 @@ class LAADSDataSet:
         # Portions of file names to include or exclude
         self.include = t_misc.listify(include)
         self.exclude = t_misc.listify(exclude)
+        # Filter built from the inclusions and exclusions (see LAADSFilenameFilter)
+        self.filename_filter = LAADSFilenameFilter(self.include, self.exclude)
+        # Incrementally refresh an existing catalog on spinup
+        self.update = update
+        # Crawl LAADS for a catalog on spinup if there is none (otherwise, see get_catalogs)
+        self.crawl = crawl
+
+        # Support store (dataset specifications, catalogs and download records)
+        self.store = c_laads_store.LAADSStore()
 
-        # Dictionaries for indexing the files
+        # Columnar catalog of the files (see LAADSCatalog)
+        self.catalog = None
+
+        # Dictionaries (or lazy catalog views) for indexing the files
         self.by_date = {}
         self.by_filename = {}
         self.by_year_doy = {}
@@ -47,6 +78,9 @@ class LAADSDataSet:
     # Spinup procedure for the object
     def spinup(self):
 
+        # Bring any legacy support files for the dataset into the store
+        self.import_legacy_support_files()
+
         # LOAD SPECIFICATION FILE, OR CREATE ONE
         # If there is a dataset file with the name
         if self.find_dataset_spec():
@@ -80,18 +114,36 @@ class LAADSDataSet:
                            'Include': self.include,
                            'Exclude': self.exclude}
             # Save the specification
-            with open(Path(environ["support_dir"], f"{self.name}_dataset_spec.json"), mode='w') as of:
-                json.dump(output_dict, of, indent=4)
+            self.store.put_dataset(output_dict)
+
+        # Build the file name filter from the (possibly loaded) inclusions and exclusions
+        self.filename_filter = LAADSFilenameFilter(self.include, self.exclude)
 
         # CATALOGS: LOAD, UPDATE, OR CREATE NEW ONE
         # Get the date of the latest catalog (or None if there is none)
         catalog_date = self.find_catalog_file()
         # If there is no catalog
         if not catalog_date:
+            # If not crawling on spinup
+            if not self.crawl:
+                # Leave the catalog to be retrieved later
+                return
             # Make a new catalog
             self.get_catalog()
             # Get the date of the latest catalog (or None if there is none)
             catalog_date = self.find_catalog_file()
+        # Otherwise, if updating the existing catalog
+        elif self.update:
+            # Refresh the catalog
+            self.refresh_catalog()
+            # Get the date of the latest catalog
+            catalog_date = self.find_catalog_file()
+        # If there is still no catalog
+        if not catalog_date:
+            # Log an error
+            logging.error(f"No catalog could be retrieved for LAADSDataSet {self.name}.")
+            # Return
+            return
         # Ingest catalog file
         self.ingest_catalog_file(catalog_date)
 
@@ -106,105 +158,103 @@ class LAADSDataSet:
                                 f" but {attr_name} {attribute} was found in a preexisting"
                                 f" dataset specification and was used.")
 
-    # Look for a dataset specification file
+    # Look for a dataset specification in the store
     def find_dataset_spec(self):
-        # Walk the support file directory
-        for root, dirs, files in walk(environ["support_dir"]):
-            # For each file name
-            for name in files:
-                # If the dataset's name is in the file name
-                if f"{self.name}_dataset_spec.json" in name:
-                    # Open the file
-                    with open(Path(root, name), 'r') as f:
-                        # Load dictionary
-                        dataset_dict = json.load(f)
-                    # Transfer the values
-                    self.archive_set = dataset_dict['Archive Set']
-                    self.product = dataset_dict['Product']
-                    # If there is a start date
-                    if dataset_dict['Start Date']:
-                        self.start_date = datetime.datetime.strptime(dataset_dict['Start Date'], '%m/%d/%Y').date()
-                    # If there is an end date
-                    if dataset_dict['End Date']:
-                        self.end_date = datetime.datetime.strptime(dataset_dict['End Date'], '%m/%d/%Y').date()
-                    self.include = dataset_dict['Include']
-                    self.exclude = dataset_dict['Exclude']
-                    # Return True
-                    return True
-        # Return False (didn't find a file)
-        return False
+        # Get the specification dictionary
+        dataset_dict = self.store.get_dataset(self.name)
+        # If there is no specification
+        if not dataset_dict:
+            # Return False (didn't find a specification)
+            return False
+        # Transfer the values
+        self.archive_set = dataset_dict['Archive Set']
+        self.product = dataset_dict['Product']
+        # If there is a start date
+        if dataset_dict['Start Date']:
+            self.start_date = datetime.datetime.strptime(dataset_dict['Start Date'], '%m/%d/%Y').date()
+        # If there is an end date
+        if dataset_dict['End Date']:
+            self.end_date = datetime.datetime.strptime(dataset_dict['End Date'], '%m/%d/%Y').date()
+        self.include = dataset_dict['Include']
+        self.exclude = dataset_dict['Exclude']
+        # Return True
+        return True
 
-    # Find the latest date for a support file containing a given string
-    def get_latest_support_file_date(self, file_str):
-        # Latest date variable
-        latest_date = None
-        # Walk the support file directory
-        for root, dirs, files in walk(environ["support_dir"]):
-            # For each file name
-            for name in files:
-                # If the dataset's name is in the file name
-                if file_str in name:
-                    # Split the name
-                    split_name = name.split('_')
-                    # Make a datetime date object from the name
-                    datetime_str = split_name[-2] + split_name[-1].split('.')[0]
-                    file_datetime = datetime.datetime.strptime(datetime_str, '%m%d%Y%H%M%S')
-                    # If there is no latest date yet
-                    if not latest_date:
-                        # Set the file's date
-                        latest_date = file_datetime
-                    # Otherwise, if the file's date is later
-                    elif file_datetime > latest_date:
-                        # Set the file's date as latest
-                        latest_date = file_datetime
-        # Return latest date
-        return latest_date
-
-    # Find the date of latest dataset catalog file
+    # Find legacy (pre-store) support files for the dataset, as a sorted list of (datetime, path) tuples
+    def find_legacy_support_files(self, file_str, suffix):
+        # List of files
+        legacy_files = []
+        # For each matching file in the support directory
+        for file_path in Path(environ["support_dir"]).glob(f'{self.name}_{file_str}_*{suffix}'):
+            # Try to make a datetime object from the name
+            try:
+                file_datetime = datetime.datetime.strptime(file_path.name[:-len(suffix)],
+                                                           f'{self.name}_{file_str}_%m%d%Y_%H%M%S')
+            # If it is not a timestamped file for this dataset
+            except ValueError:
+                # Skip it
+                continue
+            # Add to the list
+            legacy_files.append((file_datetime, file_path))
+        # Return the files in date order
+        return sorted(legacy_files)
+
+    # Import legacy JSON/TXT support files for the dataset into the store (once)
+    def import_legacy_support_files(self):
+        # Path to a legacy specification file
+        spec_path = Path(environ["support_dir"], f"{self.name}_dataset_spec.json")
+        # If there is a legacy specification and none in the store
+        if exists(spec_path) and not self.store.get_dataset(self.name):
+            # Import it
+            self.store.import_legacy_dataset(spec_path)
+        # If there is no catalog in the store
+        if not self.store.get_latest_catalog_datetime(self.name):
+            # Get the legacy catalogs
+            legacy_catalogs = self.find_legacy_support_files('catalog', '.json')
+            # If there are any
+            if legacy_catalogs:
+                # Import the latest
+                self.store.import_legacy_catalog(self.name,
+                                                 legacy_catalogs[-1][1],
+                                                 legacy_catalogs[-1][0],
+                                                 t_laads.get_date_from_filename)
+        # If there are no download attempts in the store
+        if not self.store.has_downloads(self.name):
+            # For each legacy download record
+            for download_datetime, download_path in self.find_legacy_support_files('download', '.txt'):
+                # Import it
+                self.store.import_legacy_downloads(self.name, download_path, download_datetime)
+
+    # Find the date of latest dataset catalog
     def find_catalog_file(self):
-        return self.get_latest_support_file_date(f"{self.name}_catalog_")
+        return self.store.get_latest_catalog_datetime(self.name)
+
+    # Load a catalog file as a dictionary of file names and hashes
+    def load_catalog_file(self, catalog_datetime):
+        # If the date provided is a (legacy format) string
+        if isinstance(catalog_datetime, str):
+            # Convert to a datetime object
+            catalog_datetime = datetime.datetime.strptime(catalog_datetime, '%m%d%Y_%H%M%S')
+        # Return the catalog from the store
+        return self.store.get_catalog(self.name, catalog_datetime)
 
     # Ingest a catalog file
     def ingest_catalog_file(self, catalog_datetime):
-        # If the date provided is a datetime.date object
-        if isinstance(catalog_datetime, datetime.datetime):
-            # Convert to string
-            catalog_datetime = catalog_datetime.strftime('%m%d%Y_%H%M%S')
-        # Assemble path
-        catalog_path = Path(environ['support_dir'], f'{self.name}_catalog_{catalog_datetime}.json')
-        # Open the file
-        with open(catalog_path, mode='r') as f:
-            # Convert to json
-            incoming_catalog = json.load(f)
-        # For each key (File name) in the dictionary
-        for filename in incoming_catalog.keys():
-            # Instantiate an object
-            file_obj = LAADSFile(filename,
-                                 t_laads.get_date_from_filename(filename),
-                                 incoming_catalog[filename])
-            # Store under the default indexing dictionaries
-            self.by_filename[filename] = file_obj
-            # Add sublist for date object key
-            if file_obj.date not in self.by_date.keys():
-                self.by_date[file_obj.date] = []
-            self.by_date[file_obj.date].append(file_obj)
-            # Get year and doy keys
-            year_key = str(file_obj.date.year)
-            doy_key = t_misc.get_doy_from_date(file_obj.date,
-                                               zero_pad_digits=3)
-            # Store by year and doy
-            if year_key not in self.by_year_doy.keys():
-                self.by_year_doy[year_key] = {}
-            if doy_key not in self.by_year_doy[year_key].keys():
-                self.by_year_doy[year_key][doy_key] = []
-            self.by_year_doy[year_key][doy_key].append(file_obj)
-
-    # Find the latest download file
-    def find_download_file(self):
-        return self.get_latest_support_file_date(f"{self.name}_download_")
+        # If the date provided is a (legacy format) string
+        if isinstance(catalog_datetime, str):
+            # Convert to a datetime object
+            catalog_datetime = datetime.datetime.strptime(catalog_datetime, '%m%d%Y_%H%M%S')
+        # Get the catalog columns (file names, date ordinals, hashes) from the store
+        filenames, dates, hashes = self.store.get_catalog_columns(self.name, catalog_datetime)
+        # Build the columnar catalog
+        self.catalog = LAADSCatalog(filenames, hashes, dates=dates)
+        # Reference the lazy indexing views
+        self.by_date = self.catalog.by_date
+        self.by_filename = self.catalog.by_filename
+        self.by_year_doy = self.catalog.by_year_doy
 
     # Get a brand new catalog based on a LAADSDataSet object
-    def get_catalog(self):
+    def get_catalog(self, level_workers=None, engine='threads'):
 
         # Start time
         stime = time()
@@ -213,6 +263,141 @@ class LAADSDataSet:
         logging.info(f"Starting retrieval of catalog for {self.product}"
                      f" from archive set {self.archive_set}.")
 
+        # Crawl the whole product (within the dataset's dates)
+        file_dict = self.crawl_catalog(level_workers=level_workers, engine=engine)
+
+        # If we did not get a (complete) catalog
+        if file_dict is None:
+            # Stop here
+            return
+
+        logging.info(f"File catalog for {self.product} in Archive Set {self.archive_set}"
+                     f" retrieved in {around(time() - stime, decimals=2)} seconds. Writing output...")
+
+        # Write the catalog file
+        self.write_catalog(file_dict)
+
+    # Refresh the latest catalog, re-listing only the years and DOYs that are new or could have changed
+    def refresh_catalog(self, lookback_days=32, level_workers=None, engine='threads'):
+
+        # Get the date of the latest catalog
+        catalog_date = self.find_catalog_file()
+        # If there is no catalog to refresh
+        if not catalog_date:
+            # Log the info
+            logging.info(f"No previous catalog for {self.name}. Retrieving a full catalog.")
+            # Get a full catalog instead
+            self.get_catalog(level_workers=level_workers, engine=engine)
+            # Return
+            return
+
+        # Start time
+        stime = time()
+
+        # Load the previous catalog
+        previous_catalog = self.load_catalog_file(catalog_date)
+        # Set of (year, doy) directories already in the previous catalog
+        previous_doys = set()
+        # Set of years already in the previous catalog
+        previous_years = set()
+        # Latest file date in the previous catalog
+        latest_date = None
+        # For each file in the previous catalog
+        for filename in previous_catalog.keys():
+            # Get the year and DOY
+            year, doy = t_laads.get_year_doy_from_filename(filename)
+            # Store the directory keys
+            previous_doys.add((int(year), int(doy)))
+            previous_years.add(int(year))
+            # Get the date of the file
+            file_date = t_misc.get_dateobj_from_yeardoy(year, doy)
+            # If it is the latest so far
+            if not latest_date or file_date > latest_date:
+                # Store it
+                latest_date = file_date
+
+        # If the previous catalog was empty
+        if not latest_date:
+            # Log the info
+            logging.info(f"Previous catalog for {self.name} is empty. Retrieving a full catalog.")
+            # Get a full catalog instead
+            self.get_catalog(level_workers=level_workers, engine=engine)
+            # Return
+            return
+
+        # Anything on or after the cutoff could have been (re)processed since the last catalog
+        cutoff = latest_date - datetime.timedelta(days=lookback_days)
+
+        # Log start of refresh
+        logging.info(f"Refreshing catalog for {self.product} from archive set {self.archive_set}"
+                     f" (re-listing from {cutoff.isoformat()}, plus any new directories).")
+
+        # Check a year needs to be listed (new, or could have changed)
+        def year_check(year):
+            return year >= cutoff.year or year not in previous_years
+
+        # Check a DOY needs to be listed (new, or could have changed)
+        def doy_check(date):
+            return date >= cutoff or (date.year, t_misc.get_doy_from_date(date)) not in previous_doys
+
+        # Set of (year, doy) directories that were re-listed
+        listed_doys = set()
+        # Crawl only what is needed
+        file_dict = self.crawl_catalog(year_check=year_check,
+                                       doy_check=doy_check,
+                                       listed_doys=listed_doys,
+                                       level_workers=level_workers,
+                                       engine=engine)
+
+        # If we did not get a (complete) catalog
+        if file_dict is None:
+            # Stop here
+            return
+
+        # Merged catalog
+        merged_dict = {}
+        # For each file in the previous catalog
+        for filename in previous_catalog.keys():
+            # Get the year and DOY
+            year, doy = t_laads.get_year_doy_from_filename(filename)
+            # If the directory was not re-listed
+            if (int(year), int(doy)) not in listed_doys:
+                # Keep the previous entry
+                merged_dict[filename] = previous_catalog[filename]
+        # Add (or replace with) the re-listed files
+        merged_dict.update(file_dict)
+
+        logging.info(f"Catalog for {self.product} in Archive Set {self.archive_set} refreshed from"
+                     f" {len(listed_doys)} DOY listings in {around(time() - stime, decimals=2)} seconds"
+                     f" ({len(merged_dict) - len(previous_catalog)} net new files). Writing output...")
+
+        # Write the merged catalog file
+        self.write_catalog(merged_dict)
+
+    # Crawl the product on LAADS, returning a dictionary of file names and hashes, or None if the crawl is incomplete
+    # (see check_crawl_failures). The engine is 'threads' for a thread pool, or 'async' for the asyncio engine.
+    def crawl_catalog(self, year_check=None, doy_check=None, listed_doys=None, level_workers=None, engine='threads'):
+
+        # If the engine is not known
+        if engine not in ('threads', 'async'):
+            raise ValueError(f"Unknown crawl engine {engine} (use 'threads' or 'async').")
+
+        # If using the asynchronous engine
+        if engine == 'async':
+            # Run the asynchronous crawl in its own session
+            return t_laads_async.run_with_session(
+                lambda session, semaphores: self.crawl_catalog_async(session,
+                                                                     semaphores,
+                                                                     year_check=year_check,
+                                                                     doy_check=doy_check,
+                                                                     listed_doys=listed_doys),
+                level_workers if level_workers else ASYNC_CRAWL_LEVEL_WORKERS)
+
+        # If no workers per level were specified
+        if not level_workers:
+            # Use the defaults
+            level_workers = CRAWL_LEVEL_WORKERS
+
         # URL for the archive set + product
         product_url = environ['laads_alldata_url'] + f'{self.archive_set}/{self.product}'
 
@@ -221,9 +406,123 @@ class LAADSDataSet:
 
         # If we did not get a years json
         if not years_json:
-            # Stop here
-            return
+            # Return None
+            return None
 
+        # Initial work for the pipeline (the year listings)
+        initial_work = [('year', year_url) for year_url in self.get_year_urls(years_json, year_check=year_check)]
+
+        # Dictionary for files
+        file_dict = {}
+
+        # Counters for the listings, and those that failed
+        listings = 0
+        failed = 0
+        # Crawl the listings as they are completed (year and DOY listings overlap)
+        for level, url, listing in t_misc.multithread_pipeline(t_laads.get_laads_json,
+                                                               initial_work,
+                                                               self.get_crawl_expand_func(file_dict,
+                                                                                          doy_check=doy_check,
+                                                                                          listed_doys=listed_doys),
+                                                               level_workers):
+            # Count the listing
+            listings += 1
+            # If it failed
+            if not listing:
+                failed += 1
+
+        # If the crawl is incomplete
+        if not self.check_crawl_failures(listings, failed, listed_doys=listed_doys):
+            # Return None
+            return None
+
+        # Return the file dictionary
+        return file_dict
+
+    # Check the failed listings of a crawl, returning False if the crawl is incomplete. A full crawl with any failed
+    # listing is incomplete (its missing files would look removed in a catalog diff, and superseded files would be
+    # removed locally). A refresh recording its listed DOYs is not, as failed directories keep their previous entries.
+    def check_crawl_failures(self, listings, failed, listed_doys=None):
+        # If no listings failed
+        if not failed:
+            return True
+        # If this is a refresh recording its listed DOYs
+        if listed_doys is not None:
+            # Log a warning
+            logging.warning(f'{failed} of {listings} listings failed while crawling {self.product} in archive set '
+                            f'{self.archive_set}. Keeping their previous entries.')
+            return True
+        # Log an error
+        logging.error(f'{failed} of {listings} listings failed while crawling {self.product} in archive set '
+                      f'{self.archive_set}. Not using the incomplete catalog.')
+        # Return False
+        return False
+
+    # Crawl the product on LAADS asynchronously with a shared session and level semaphores (see t_laads_async),
+    # returning a dictionary of file names and hashes, or None if the crawl is incomplete (see check_crawl_failures)
+    async def crawl_catalog_async(self, session, semaphores, year_check=None, doy_check=None, listed_doys=None):
+
+        # URL for the archive set + product
+        product_url = environ['laads_alldata_url'] + f'{self.archive_set}/{self.product}'
+
+        # Get a json of the years
+        years_json = await t_laads_async.get_laads_json(session, semaphores['year'], product_url)
+
+        # If we did not get a years json
+        if not years_json:
+            # Return None
+            return None
+
+        # Initial work for the pipeline (the year listings)
+        initial_work = [('year', year_url) for year_url in self.get_year_urls(years_json, year_check=year_check)]
+
+        # Dictionary for files
+        file_dict = {}
+
+        # Crawl the listings, counting them and those that failed
+        listings, failed = await t_laads_async.crawl_pipeline(session,
+                                                              semaphores,
+                                                              initial_work,
+                                                              self.get_crawl_expand_func(file_dict,
+                                                                                         doy_check=doy_check,
+                                                                                         listed_doys=listed_doys))
+
+        # If the crawl is incomplete
+        if not self.check_crawl_failures(listings, failed, listed_doys=listed_doys):
+            # Return None
+            return None
+
+        # Return the file dictionary
+        return file_dict
+
+    # Get a function to handle a completed crawl listing (adding files to file_dict), returning the work it feeds
+    def get_crawl_expand_func(self, file_dict, doy_check=None, listed_doys=None):
+
+        # Handle a completed listing
+        def expand_func(level, url, listing):
+            # If the listing failed
+            if not listing:
+                # No further work (it was logged by the request)
+                return []
+            # If this was a year listing
+            if level == 'year':
+                # Feed its DOY listings straight into the pipeline
+                return [('doy', doy_url) for doy_url in self.get_doy_urls(listing, doy_check=doy_check)]
+            # Otherwise (DOY listing), add its files to the dictionary
+            self.add_doy_listing(listing, file_dict)
+            # If recording the listed DOYs
+            if listed_doys is not None:
+                # Add the year and DOY (only once the listing succeeded, so a failed DOY keeps its previous entries)
+                year, doy = url.rstrip('/').split('/')[-2:]
+                listed_doys.add((int(year), int(doy)))
+            # No further work
+            return []
+
+        # Return the function
+        return expand_func
+
+    # Get the URLs of the years to crawl from a product listing
+    def get_year_urls(self, years_json, year_check=None):
         # List for the years urls
         years_urls = []
         # For each year in the json
@@ -232,9 +531,9 @@ class LAADSDataSet:
             year_name = year['name']
             # Check it is a valid year
             try:
-                curr_date = datetime.date(year=(int(year_name)),
-                                          day=1,
-                                          month=1)
+                datetime.date(year=(int(year_name)),
+                              day=1,
+                              month=1)
             except:
                 logging.warning(f'Year {year_name} in product {self.product}'
                                 f' in Archive Set {self.archive_set} is not a valid year.')
@@ -250,95 +549,78 @@ class LAADSDataSet:
                 if int(year['name']) > self.end_date.year:
                     # Skip it
                     continue
+            # If the year cannot pass the file name filter (e.g. a date predicate)
+            if not self.filename_filter.check_year(int(year_name)):
+                # Skip it
+                continue
+            # If there is a year check and the year does not pass it
+            if year_check and not year_check(int(year_name)):
+                # Skip it
+                continue
             # Get the URL and append to list
             years_urls.append(t_laads.convert_link_to_url(year['downloadsLink']))
+        # Return the URLs
+        return years_urls
+
+    # Get the URLs of the DOYs to crawl from a year listing
+    def get_doy_urls(self, year_json, doy_check=None):
         # List for the doys urls
         doys_urls = []
+        # For each doy in the result
+        for doy in year_json['content']:
+            # Get the URL
+            doy_url = t_laads.convert_link_to_url(doy['downloadsLink'])
+            # Get the year
+            year = doy_url.split('/')[-2]
+            # Get the date of the DOY
+            doy_date = t_misc.get_dateobj_from_yeardoy(int(year), int(doy['name']))
+            # If the dataset has a specified start date
+            if self.start_date:
+                # If the doy is before the start date
+                if doy_date < self.start_date:
+                    # Skip the DOY
+                    continue
+            # If the dataset has a specified end date
+            if self.end_date:
+                # If the doy is after the end date
+                if doy_date > self.end_date:
+                    # Skip the DOY
+                    continue
+            # If the DOY cannot pass the file name filter (e.g. a date predicate)
+            if not self.filename_filter.check_date(doy_date):
+                # Skip the DOY
+                continue
+            # If there is a DOY check and the DOY does not pass it
+            if doy_check and not doy_check(doy_date):
+                # Skip the DOY
+                continue
+            # Add the URL to the list
+            doys_urls.append(doy_url)
+        # Return the URLs
+        return doys_urls
 
-        # Multithread crawl through the years
-        futures = t_misc.multithread(t_laads.get_laads_json, years_urls, as_completed_yield=True)
-
-        # For each future
-        for future in futures:
-            # For each doy in the result
-            for doy in future.result()['content']:
-                # Get the URL
-                doy_url = t_laads.convert_link_to_url(doy['downloadsLink'])
-                # Get the year
-                year = doy_url.split('/')[-2]
-                # If the dataset has a specified start date
-                if self.start_date:
-                    # If the doy is before the start date
-                    if t_misc.get_dateobj_from_yeardoy(int(year), int(doy['name'])) < self.start_date:
-                        # Skip the DOY
-                        continue
-                # If the dataset has a specified end date
-                if self.end_date:
-                    # If the doy is after the end date
-                    if t_misc.get_dateobj_from_yeardoy(int(year), int(doy['name'])) > self.end_date:
-                        # Skip the DOY
-                        continue
-                # Add the URL to the list
-                doys_urls.append(doy_url)
-        # Log information
-        logging.info(f"Total of {len(doys_urls)} days entering multithreaded crawling.")
-
-        # Multithread crawl through the days
-        futures = t_misc.multithread(t_laads.get_laads_json, doys_urls, as_completed_yield=True)
-
-        # Dictionary for files
-        file_dict = {}
-
-        # For each future
-        for future in futures:
-            # For each file in the result
-            for file in future.result()['content']:
-                # If there are inclusions
-                if self.include:
-                    # Pass inclusions switch
-                    pass_includes = True
-                    # For each inclusion
-                    for include in self.include:
-                        # If the inclusion is not in the file name
-                        if include not in file['name']:
-                            # Flip the switch
-                            pass_includes = False
-                    # If failed any includes
-                    if not pass_includes:
-                        # Skip the file
-                        continue
-                # If there are exclusions
-                if self.exclude:
-                    # Pass exclusions switch
-                    pass_excludes = True
-                    # For each exclusion
-                    for exclude in self.exclude:
-                        # If the exclusion is in the file name
-                        if exclude in file['name']:
-                            # Flip the switch
-                            pass_excludes = False
-                    # If failed any excludes
-                    if not pass_excludes:
-                        # Skip the file
-                        continue
-                # Add to file dictionary
-                file_dict[file['name']] = file['md5sum']
-
-        logging.info(f"File catalog for {self.product} in Archive Set {self.archive_set}"
-                     f" retrieved in {around(time() - stime, decimals=2)} seconds. Writing output...")
+    # Add the files from a DOY listing to a dictionary of file names and hashes
+    def add_doy_listing(self, doy_json, file_dict):
+        # Hashes by file name for the listing
+        hashes = {file['name']: file['md5sum'] for file in doy_json['content']}
+        # For each file name that passes the inclusions and exclusions (filtered together)
+        for filename in self.filename_filter.filter_names(list(hashes.keys())):
+            # Add to file dictionary
+            file_dict[filename] = hashes[filename]
 
-        # End datetime string
-        end = datetime.datetime.now().strftime("%m%d%Y_%H%M%S")
+    # Write a catalog dictionary to a new catalog in the store (or another connection to it, e.g. from another thread)
+    def write_catalog(self, file_dict, store=None):
 
-        # Assemble the path to the catalog file
-        output_path = Path(
-            environ["support_dir"], f"{self.name}_catalog_" + end + ".json")
+        # If no store was provided
+        if not store:
+            # Use the dataset's store
+            store = self.store
 
-        # When we're finished, save the dictionary
-        with open(output_path, 'w') as of:
-            json.dump(file_dict, of, indent=4)
+        # Store the catalog
+        catalog_datetime = store.put_catalog(self.name, file_dict, t_laads.get_date_from_filename)
 
-        logging.info(f"Output saved to {output_path}.")
+        logging.info(f"Catalog of {len(file_dict)} files saved to {store.store_path}"
+                     f" ({catalog_datetime.isoformat()}).")
 
     # Get a URL from a filename
     def get_url_from_filename(self, filename):
@@ -352,8 +634,25 @@ class LAADSDataSet:
                f'/{doy}' + \
                f'/{filename}'
 
+    # Get the path to the downloaded copy of a file
+    def get_file_path(self, filename):
+        return Path(environ['inputs_dir'], self.name, filename)
+
     # Download the whole catalog
-    def download_catalog(self, from_scratch=False, chunk_size=20):
+    # (with a LAADSCatalogDiff, only its added and changed files are downloaded, and superseded local copies are
+    # removed or flagged: superseded='remove', 'flag' or None. With a list of (file name, hash) tuples in to_download,
+    # e.g. from t_mcd43gf.plan_downloads, only those files are downloaded.)
+    def download_catalog(self,
+                         from_scratch=False,
+                         workers=DOWNLOAD_WORKERS,
+                         max_in_flight=None,
+                         record_every=20,
+                         adaptive=False,
+                         deep_validate=False,
+                         deep_workers=4,
+                         diff=None,
+                         superseded='remove',
+                         to_download=None):
         # Directory to download to
         download_dir = Path(environ['inputs_dir'], self.name)
         # If there is a directory to store the files
@@ -368,128 +667,276 @@ class LAADSDataSet:
         else:
             # Make the directory
             mkdir(download_dir)
-        # Get the download record to date
-        download_dict = self.get_download_record()
-        # List of work for multithreading
-        list_of_work = []
-        # Empty list for chunk of work
-        chunk = []
-        # File count
-        file_count = 0
-        # For each filename
-        for filename in self.by_filename.keys():
-            # If the file is already in the download dictionary
-            if filename in download_dict.keys():
-                # If the status is anything other than True
-                if not download_dict[filename]:
-                    # Add tuple of URL and hash to the chunk
-                    chunk.append((self.get_url_from_filename(filename), self.by_filename[filename].hash))
-            # Otherwise (not in download dictionary)
-            else:
-                # Add tuple of URL and hash to the chunk
-                chunk.append((self.get_url_from_filename(filename), self.by_filename[filename].hash))
-            # If the chunk has reach the max size
-            if len(chunk) == chunk_size:
-                # Add to file count
-                file_count += chunk_size
-                # Append chunk to the list of work
-                list_of_work.append(chunk)
-                # Reinitialize the chunk
-                chunk = []
-        # If there are any files in the final chunk
-        if len(chunk) > 0:
-            # Add to file count
-            file_count += len(chunk)
-            # Append chunk to the list of work
-            list_of_work.append(chunk)
-        # Log information about the list of work
-        logging.info(f'Sending {file_count} files in {len(list_of_work)} chunks to multithreaded download.')
+        # If a list of files to download was provided
+        if to_download is not None:
+            # Download only those files
+            to_download = list(to_download)
+        # Otherwise, if there is a catalog diff
+        elif diff:
+            # Handle the local copies superseded by the diff
+            self.handle_superseded_files(diff, superseded)
+            # Download only the added and changed files
+            to_download = diff.get_download_list()
+        # Otherwise
+        else:
+            # List of file names and hashes to download
+            to_download = []
+            # Get the download record to date
+            download_dict = self.get_download_record()
+            # For each filename
+            for filename in self.by_filename.keys():
+                # If the file is already in the download dictionary
+                if filename in download_dict.keys():
+                    # If the status is anything other than True
+                    if not download_dict[filename]:
+                        # Add tuple of file name and hash
+                        to_download.append((filename, self.by_filename[filename].hash))
+                # Otherwise (not in download dictionary)
+                else:
+                    # Add tuple of file name and hash
+                    to_download.append((filename, self.by_filename[filename].hash))
+        # If there is nothing to download
+        if not to_download:
+            # Log the info
+            logging.info(f'No files to download for {self.name}.')
+            # Return
+            return
+        # Work for the download queue (tuples of URL, hash and write path), generated as the workers need it
+        work_iter = ((self.get_url_from_filename(filename), file_hash, Path(environ['inputs_dir'], self.name, filename))
+                     for filename, file_hash in to_download)
+        # Download function
+        download_func = t_laads.download_laads_file
+        # If the concurrency should adapt to the server
+        if adaptive:
+            # Reference the shared concurrency limiter
+            limiter = c_aimd_limiter.get_laads_limiter()
+            # Enough workers for the limiter's maximum (the limiter decides how many are downloading)
+            workers = limiter.max_limit
+            # Download under the limiter
+            download_func = partial(t_laads.download_laads_file, limiter=limiter)
+        # Log information about the work
+        logging.info(f'Sending {len(to_download)} files to {workers} download workers.')
         # Mark start time
         stime = time()
-        # Get datetime string
-        now_str = datetime.datetime.now().strftime("%m%d%Y_%H%M%S")
-
-        # Open a download log in write mode
-        of = open(Path(environ['support_dir'],
-                           f'{self.name}_download_{now_str}.txt'),
-                  mode='w')
-
-        # Get the file suffix for the first file
-        file_suffix = list(self.by_filename.keys())[0].split('.')[-1]
-        # Set multithread function to h5
-        mt_func = t_laads.get_laads_hdf5
-        # If this is a hdf4 catalog
-        if file_suffix == 'hdf':
-            # Swap the multithread function for HDF4 retrieval
-            mt_func = t_laads.get_laads_hdf4
-        # While there are chunks to process
-        while list_of_work:
-            # Pop a chunk to process
-            current_chunk = list_of_work.pop()
-            # Multithread
-            futures = t_misc.multithread(mt_func, current_chunk, as_completed_yield=True)
-            # For each future as it is completed
-            for future in as_completed(futures):
-                # Split out the file and filename
-                file = future.result()[1]
-                filename = future.result()[0].split('/')[-1]
-                # If we did not get the file
-                if not file:
-                    # Write a line to the download log
-                    of.write(f'{filename} False\n')
-                # Otherwise, if we did not get content
-                elif not file.content:
-                    # Write a line to the download log
-                    of.write(f'{filename} False\n')
-                # Otherwise
-                else:
-                    # Get the write path for the file
-                    write_path = Path(environ['inputs_dir'], self.name, filename)
-                    # Write the file locally
-                    write_result = t_misc.write_bytes(file.content, write_path)
-                    # If the result was successful
-                    if write_result:
-                        # Write a line to the download log
-                        of.write(f'{filename} True\n')
-                    # Otherwise
-                    else:
-                        # Write a line to the download log
-                        of.write(f'{filename} False\n')
-        # Close the log file
-        of.close()
+        # List of download results not yet recorded
+        results = []
+        # If downloaded files get a deep validation (opened and listed), start a process pool for it (off the
+        # download threads), and a dictionary of its futures to their file names
+        deep_executor = ProcessPoolExecutor(max_workers=deep_workers) if deep_validate else None
+        deep_futures = {}
+        # For each file as it is completed (workers take the next file as soon as they finish one)
+        for work, (url, downloaded) in t_misc.multithread_queue(download_func,
+                                                                work_iter,
+                                                                max_workers=workers,
+                                                                max_in_flight=max_in_flight):
+            # If the file was downloaded and gets a deep validation
+            if downloaded and deep_executor:
+                # Send it to the process pool (its result is recorded when the validation finishes)
+                deep_futures[deep_executor.submit(t_hdf.validate_file_deep, str(work[2]))] = url.split('/')[-1]
+            # Otherwise
+            else:
+                # Add the file name and status to the download results
+                results.append((url.split('/')[-1], downloaded))
+            # Add the results of any finished deep validations
+            results.extend(self.collect_deep_validations(deep_futures))
+            # If there are enough results to record
+            if len(results) >= record_every:
+                # Record them in the store
+                self.store.add_downloads(self.name, results)
+                results = []
+        # If there is a deep validation pool
+        if deep_executor:
+            # Wait for the remaining deep validations and add their results
+            results.extend(self.collect_deep_validations(deep_futures, wait_for_all=True))
+            # Close the pool
+            deep_executor.shutdown()
+        # Record any remaining results in the store
+        self.store.add_downloads(self.name, results)
+        # Compact the download journal if it has grown too long
+        self.store.compact_downloads(self.name)
         # Report on the overall time taken
         logging.info(f"All downloads finished in {around(time() - stime, decimals=2)} seconds.")
+        # If the concurrency adapted to the server
+        if adaptive:
+            # Report on the limiter
+            logging.info(f'Concurrency limiter after downloads: {limiter.get_stats()}.')
 
+    # Collect finished deep validations (futures of t_hdf.validate_file_deep) as (file name, status) tuples, removing
+    # files that failed. Finished futures are removed from the dictionary of futures to file names.
+    def collect_deep_validations(self, deep_futures, wait_for_all=False):
+        # List of results
+        results = []
+        # For each future that is finished (or all of them, waiting if required)
+        for future in [future for future in deep_futures.keys() if wait_for_all or future.done()]:
+            # Get the file name
+            filename = deep_futures.pop(future)
+            # Try to get the result (the pool may have broken, or the validation raised)
+            try:
+                passed = future.result()
+            # If not successful
+            except Exception as e:
+                # Log a warning
+                logging.warning(f'Deep validation of {filename} raised {type(e).__name__}: {e}')
+                passed = False
+            # If the file passed
+            if passed:
+                results.append((filename, True))
+            # Otherwise
+            else:
+                # Log a warning
+                logging.warning(f'{filename} failed deep validation. Removing it.')
+                # Try to remove the file
+                try:
+                    remove(Path(environ['inputs_dir'], self.name, filename))
+                # If it is already gone
+                except FileNotFoundError:
+                    pass
+                results.append((filename, False))
+        # Return the results
+        return results
+
+    # Verify the files in the download directory against the catalog hashes, returning (file name, status) tuples.
+    # Files are hashed in bounded chunks across a process pool, and each verified file is recorded in a ledger by
+    # (path, size, mtime, inode, md5), so a file that is unchanged since it was last verified is not read again.
+    # Files that are not in the catalog, or do not match their hash, are removed if remove_invalid is True.
+    def verify_downloads(self, workers=None, remove_invalid=True, chunk_size=t_misc.HASH_CHUNK_SIZE):
+        # Directory of the downloads
+        download_dir = Path(environ['inputs_dir'], self.name)
+        # If there is no directory
+        if not exists(download_dir):
+            # Nothing to verify
+            return []
+        # Get the ledger of verified files
+        ledger = self.store.get_verified_files(self.name)
+        # List of results
+        results = []
+        # Lists of files to hash (paths and their stats), and invalid files to remove
+        to_hash = []
+        to_remove = []
+        # Set of paths seen
+        seen = set()
+        # For each entry in the download directory
+        for entry in scandir(download_dir):
+            # Add it to the paths seen
+            seen.add(entry.path)
+            # If it is not a file, or it is a partial download (kept so it can be resumed)
+            if not entry.is_file() or entry.name.endswith(('.tmp', '.tmp.json')):
+                # Leave it
+                continue
+            # If the file is not in the catalog
+            if entry.name not in self.by_filename.keys():
+                # Mark it for removal
+                to_remove.append(entry.path)
+                continue
+            # Get the stats of the file (the key for the ledger)
+            stat = entry.stat()
+            key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            # If the ledger has the file unchanged since it was verified, with the catalog hash
+            if ledger.get(entry.path, (None,))[:3] == key and \
+                    ledger[entry.path][3] == self.by_filename[entry.name].hash:
+                # It is verified without reading it
+                results.append((entry.name, True))
+            # Otherwise
+            else:
+                # Add it to the files to hash
+                to_hash.append((entry.path, entry.name, key))
+        # Log the info
+        logging.info(f'Verifying {self.name}: {len(results)} files unchanged since verified, {len(to_hash)} to hash.')
+        # Ledger rows for newly verified files
+        verified = []
+        # Hash the files across a process pool
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # For each file and its hash (in order)
+            for (path, name, key), file_hash in zip(to_hash, executor.map(partial(t_misc.get_file_md5,
+                                                                                  chunk_size=chunk_size),
+                                                                          [path for path, name, key in to_hash],
+                                                                          chunksize=16)):
+                # If the hash matches the catalog
+                if file_hash == self.by_filename[name].hash:
+                    # Add the file to the results and the ledger
+                    results.append((name, True))
+                    verified.append((path, *key, file_hash))
+                # Otherwise
+                else:
+                    # Add the file to the results, and mark it for removal
+                    results.append((name, False))
+                    to_remove.append(path)
+        # Record the newly verified files in the ledger
+        self.store.put_verified_files(self.name, verified)
+        # Remove any invalid files, and files that are gone, from the ledger
+        self.store.remove_verified_files(to_remove + [path for path in ledger.keys() if path not in seen])
+        # If invalid files are to be removed
+        if remove_invalid:
+            # Log the info
+            logging.info(f'Removing {len(to_remove)} invalid files from {download_dir}.')
+            # For each invalid file
+            for path in to_remove:
+                # Remove it
+                remove(path)
+        # Return the results
+        return results
+
+    # Get the differences between two catalogs of the dataset (by default, the two latest) as a LAADSCatalogDiff
+    def diff_catalogs(self, old_datetime=None, new_datetime=None):
+        # Datetimes of the catalogs, oldest first
+        catalog_datetimes = self.store.get_catalog_datetimes(self.name)
+        # If there is no new catalog specified
+        if not new_datetime:
+            # Use the latest
+            new_datetime = catalog_datetimes[-1] if catalog_datetimes else None
+        # If there is no old catalog specified
+        if not old_datetime:
+            # Use the latest before the new catalog
+            earlier = [catalog_datetime for catalog_datetime in catalog_datetimes if catalog_datetime < new_datetime]
+            old_datetime = earlier[-1] if earlier else None
+        # If there are not two catalogs to compare
+        if not old_datetime or not new_datetime:
+            # Log a warning
+            logging.warning(f'LAADSDataSet {self.name} does not have two catalogs to compare.')
+            # Return None
+            return None
+        # Compare the catalogs, streaming them from the store
+        diff = LAADSCatalogDiff(self.store.iter_catalog(self.name, old_datetime),
+                                self.store.iter_catalog(self.name, new_datetime))
+        # Log the info
+        logging.info(f'Catalog diff for {self.name} ({old_datetime.isoformat()} to {new_datetime.isoformat()}):'
+                     f' {diff.summary()}.')
+        # Return the diff
+        return diff
+
+    # Remove or flag local copies of files superseded in a catalog diff
+    def handle_superseded_files(self, diff, superseded='remove'):
+        # If leaving superseded files alone
+        if not superseded:
+            # Return
+            return
+        # List of superseded files that were present locally
+        handled = []
+        # For each superseded file name and its replacement (None if removed from the catalog)
+        for filename, replaced_by in diff.get_superseded_list():
+            # Path to the local copy
+            file_path = Path(environ['inputs_dir'], self.name, filename)
+            # If there is no local copy
+            if not exists(file_path):
+                # Skip it
+                continue
+            # If removing the local copies
+            if superseded == 'remove':
+                # Log the info
+                logging.info(f'Removing superseded file {file_path} (replaced by {replaced_by}).')
+                # Remove it
+                remove(file_path)
+            # Add to the handled list
+            handled.append((filename, replaced_by))
+        # Record the superseded files in the store
+        self.store.add_superseded(self.name, handled, removed=superseded == 'remove')
+        # Remove the download attempts of removed files (so they are no longer recorded as downloaded)
+        if superseded == 'remove':
+            self.store.remove_downloads(self.name, [filename for filename, replaced_by in handled])
+
+    # Get the download record (True if the latest attempt for a file succeeded)
     def get_download_record(self):
-        # Download dictionary
-        download_dict = {}
-        # Walk the support file directory
-        for root, dirs, files in walk(environ["support_dir"]):
-            # For each file name
-            for name in files:
-                # If the dataset's name and download is in the file name
-                if f'{self.name}_download_' in name:
-                    # Open the file
-                    f = open(Path(environ['support_dir'], name), mode='r')
-                    # For each line
-                    for line in f:
-                        # Split the line on the space
-                        split_line = line.strip().split(' ')
-                        # Set the status
-                        status = False
-                        # Convert the status
-                        if split_line[1] == 'True':
-                            status = True
-                        # If the filename is not in the download dict
-                        if split_line[0] not in download_dict.keys():
-                            # Add it, with the status
-                            download_dict[split_line[0]] = status
-                        # Otherwise, if the status is True
-                        elif status:
-                            # Swap the status to True
-                            download_dict[split_line[0]] = status
-        # Return the download record
-        return download_dict
+        return self.store.get_download_record(self.name)
 
     def print_download_report(self, print_failed=False, print_not_tried=False):
 
@@ -540,6 +987,654 @@ class LAADSDataSet:
                 print(not_tried_file)
 
 
+# Get new catalogs for several LAADSDataSet objects in one concurrent crawl (shared session and request limits). Each
+# catalog is written as soon as its crawl is finished, by a writer thread with its own store connection (so the store's
+# blocking I/O stays out of the event loop, and finished catalogs are kept if the run stops), and the catalogs are
+# ingested once the crawl is finished. Returns the list of datasets whose catalogs could not be retrieved (empty if all
+# succeeded).
+def get_catalogs(datasets, level_workers=None, only_missing=True):
+
+    # If only getting missing catalogs
+    if only_missing:
+        # Skip datasets that already have a catalog
+        datasets = [dataset for dataset in datasets if dataset.catalog is None]
+
+    # Log start of catalogs
+    logging.info(f"Starting retrieval of catalogs for {len(datasets)} datasets.")
+
+    # Start time
+    stime = time()
+
+    # Crawl one dataset, returning it and its file dictionary (None if the crawl failed)
+    async def crawl_dataset(session, semaphores, dataset):
+        # Try to crawl the dataset
+        try:
+            file_dict = await dataset.crawl_catalog_async(session, semaphores)
+        # If there was an unexpected error (so it does not stop the other crawls)
+        except Exception as e:
+            # Log the error
+            logging.error(f"Crawl of {dataset.name} raised {type(e).__name__}: {e}")
+            file_dict = None
+        # If we got a catalog
+        if file_dict is not None:
+            logging.info(f"File catalog for {dataset.name} retrieved after {around(time() - stime, decimals=2)}"
+                         f" seconds.")
+        # Return the dataset and file dictionary
+        return dataset, file_dict
+
+    # Write a catalog on the writer thread (with a connection to the store of its own), returning True if written
+    def write_dataset(dataset, file_dict):
+        # Open a connection to the dataset's store
+        store = c_laads_store.LAADSStore(dataset.store.store_path)
+        # Try to write the catalog
+        try:
+            dataset.write_catalog(file_dict, store=store)
+        # If not successful
+        except Exception as e:
+            # Log the error
+            logging.error(f"Writing the catalog for {dataset.name} raised {type(e).__name__}: {e}")
+            return False
+        # Close the connection
+        finally:
+            store.close()
+        # Return True
+        return True
+
+    # Crawl all the datasets together, writing each catalog as its crawl finishes. Returns the written datasets.
+    async def crawl_datasets(session, semaphores):
+        # Reference the event loop
+        loop = asyncio.get_event_loop()
+        # List of written datasets
+        written = []
+        # With a single writer thread (the store has one writer at a time)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # For each crawl, as it finishes
+            for crawl in asyncio.as_completed([crawl_dataset(session, semaphores, dataset) for dataset in datasets]):
+                # Get the dataset and its file dictionary
+                dataset, file_dict = await crawl
+                # If we got a catalog, and it was written (the other crawls carry on meanwhile)
+                if file_dict is not None and await loop.run_in_executor(executor, write_dataset, dataset, file_dict):
+                    # Add to the written list
+                    written.append(dataset)
+        # Return the written datasets
+        return written
+
+    # Run the crawl in one session
+    written = t_laads_async.run_with_session(crawl_datasets,
+                                             level_workers if level_workers else ASYNC_CRAWL_LEVEL_WORKERS)
+
+    # List of datasets whose catalogs failed
+    failed = []
+    # For each dataset
+    for dataset in datasets:
+        # If its catalog was not written
+        if dataset not in written:
+            # Log an error
+            logging.error(f"Catalog retrieval for {dataset.name} failed.")
+            # Add to the failed list
+            failed.append(dataset)
+            continue
+        # Ingest the catalog
+        dataset.ingest_catalog_file(dataset.find_catalog_file())
+
+    # Log the overall time
+    logging.info(f"Catalogs for {len(datasets) - len(failed)} of {len(datasets)} datasets retrieved in "
+                 f"{around(time() - stime, decimals=2)} seconds.")
+
+    # Return the failed datasets
+    return failed
+
+
+# Read-only view of several LAADSDataSet shards of the same product (e.g. MCD43D01_1 and MCD43D01_2) as one sorted
+# catalog, for date lookups and range queries without visiting each shard. Where shards have files for the same date,
+# the date's files all come from the first shard in the list that has it, so the result does not depend on which
+# shards were crawled or downloaded first.
+class LAADSMergedDataSet:
+
+    def __init__(self, shards):
+
+        self.shards = shards
+        self.name = '+'.join([shard.name for shard in shards])
+        self.product = shards[0].product if shards else None
+        # Merged catalog (see LAADSCatalog), and the index of the shard for each of its unique dates
+        self.catalog = None
+        self.date_shards = None
+        # Lazy indexing views of the merged catalog
+        self.by_date = {}
+        self.by_filename = {}
+        self.by_year_doy = {}
+        # If the shards are not all of the same product
+        if len({shard.product for shard in shards}) != 1:
+            # Log an error
+            logging.error(f'Shards {self.name} are not all of one product. They will not be merged.')
+            return
+        # If any shard has no catalog
+        if any(shard.catalog is None for shard in shards):
+            # Log an error
+            logging.error(f'Shards {self.name} do not all have catalogs. They will not be merged.')
+            return
+        # Merge the catalogs
+        self.merge_catalogs()
+
+    # Merge the catalogs of the shards
+    def merge_catalogs(self):
+        # Concatenate the columns of the shards' catalogs
+        names = np.concatenate([shard.catalog.names for shard in self.shards])
+        dates = np.concatenate([shard.catalog.dates for shard in self.shards])
+        hashes = np.concatenate([shard.catalog.hashes for shard in self.shards])
+        # Index of the shard of each file
+        shard_indices = np.concatenate([np.full(len(shard.catalog), index, dtype=np.int32)
+                                        for index, shard in enumerate(self.shards)])
+        # Order by date, then shard
+        order = np.lexsort((shard_indices, dates))
+        # First shard with each date (the first of its files in the order)
+        unique_dates, starts, inverse = np.unique(dates[order], return_index=True, return_inverse=True)
+        # Keep only the files from the first shard with their date
+        keep = order[shard_indices[order] == shard_indices[order][starts][inverse]]
+        # Build the merged catalog
+        self.catalog = LAADSCatalog(names[keep], hashes[keep], dates=dates[keep])
+        # Shard of each unique date (in the order of the catalog's unique dates)
+        self.date_shards = shard_indices[order][starts]
+        # Reference the lazy indexing views
+        self.by_date = self.catalog.by_date
+        self.by_filename = self.catalog.by_filename
+        self.by_year_doy = self.catalog.by_year_doy
+
+    # Get the shard that a file in the merged catalog comes from (or None if it is not in the catalog)
+    def get_shard(self, filename):
+        # Get the index of the file
+        index = self.catalog.get_index(filename)
+        # If it is not in the catalog
+        if index is None:
+            return None
+        # Return the shard of its date
+        return self.shards[self.date_shards[np.searchsorted(self.catalog.unique_dates, self.catalog.dates[index])]]
+
+    # Get the path to the downloaded copy of a file (in the directory of its shard), or None if it is not in the catalog
+    def get_file_path(self, filename):
+        # Get the shard of the file
+        shard = self.get_shard(filename)
+        # If it is not in the catalog
+        if shard is None:
+            return None
+        # Return the path
+        return shard.get_file_path(filename)
+
+    # Get the LAADSFile objects dated from a start date to an end date (inclusive)
+    def get_files_between(self, start_date, end_date):
+        return self.catalog.get_files(self.catalog.get_date_range_slice(start_date, end_date))
+
+
+# Differences between two catalogs, from iterables of (file name, hash) tuples, matched by granule (the file name
+# without its production timestamp) so that reprocessed files are found as changed rather than removed and added
+class LAADSCatalogDiff:
+
+    def __init__(self, old_files, new_files):
+
+        # Lists of (file name, hash) tuples for added and removed files
+        self.added = []
+        self.removed = []
+        # List of (old file name, old hash, new file name, new hash) tuples for changed files
+        self.changed = []
+        # Count of unchanged files
+        self.unchanged = 0
+
+        # Old files by granule key
+        old_by_granule = {}
+        # For each old file
+        for filename, file_hash in old_files:
+            old_by_granule[t_laads.get_granule_key_from_filename(filename)] = (filename, file_hash)
+        # For each new file (in one pass)
+        for filename, file_hash in new_files:
+            # Take the old file for the granule (if any)
+            old_file = old_by_granule.pop(t_laads.get_granule_key_from_filename(filename), None)
+            # If there was no old file
+            if not old_file:
+                # Added
+                self.added.append((filename, file_hash))
+            # Otherwise, if the file name or hash are different
+            elif old_file[0] != filename or old_file[1] != file_hash:
+                # Changed
+                self.changed.append((old_file[0], old_file[1], filename, file_hash))
+            # Otherwise
+            else:
+                # Unchanged
+                self.unchanged += 1
+        # Any old files left over were removed
+        self.removed = list(old_by_granule.values())
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    # Get a summary string of the differences
+    def summary(self):
+        return f'{len(self.added)} added, {len(self.removed)} removed, {len(self.changed)} changed,' \
+               f' {self.unchanged} unchanged'
+
+    # Get the (file name, hash) tuples to download (added and changed files)
+    def get_download_list(self):
+        return self.added + [(new_name, new_hash) for old_name, old_hash, new_name, new_hash in self.changed]
+
+    # Get the (file name, replaced by) tuples of superseded files (removed and renamed files)
+    def get_superseded_list(self):
+        return [(filename, None) for filename, file_hash in self.removed] + \
+               [(old_name, new_name) for old_name, old_hash, new_name, new_hash in self.changed
+                if old_name != new_name]
+
+
+# Filter for LAADS file names from inclusion and exclusion terms. Each term is a predicate on a parsed file name field
+# ('field=value' for product, date (YYYY-MM-DD or AYYYYDDD), year, doy, tile or collection), a bare tile (h11v07) or
+# date (A2019152), or otherwise a substring. Date predicates are pushed down to skip year and DOY listings entirely.
+class LAADSFilenameFilter:
+
+    # Fields that can be used in predicates
+    fields = ['product', 'date', 'year', 'doy', 'tile', 'collection']
+
+    def __init__(self, include=None, exclude=None):
+
+        # Lists of (field, value) predicates
+        self.include = [self.parse_term(term) for term in t_misc.listify(include)]
+        self.exclude = [self.parse_term(term) for term in t_misc.listify(exclude)]
+
+    # Parse a term into a (field, value) predicate
+    def parse_term(self, term):
+        # If the term names a field
+        if '=' in term:
+            # Split the field and value
+            field, value = [part.strip() for part in term.split('=', 1)]
+            # If it is not a known field
+            if field not in self.fields:
+                # Raise an error
+                raise ValueError(f'Unknown file name field {field} in {term} (use one of {self.fields}).')
+            # If the field is a date
+            if field == 'date':
+                # If it is a LAADS format date
+                if re.fullmatch(r'A\d{7}', value):
+                    return field, t_misc.get_dateobj_from_yeardoy(value[1:5], value[5:8])
+                return field, datetime.date.fromisoformat(value)
+            # If the field is a number
+            if field in ['year', 'doy']:
+                return field, int(value)
+            # Otherwise (string field)
+            return field, value
+        # If the term is a bare tile
+        if re.fullmatch(r'h\d{2}v\d{2}', term):
+            return 'tile', term
+        # If the term is a bare LAADS format date
+        if re.fullmatch(r'A\d{7}', term):
+            return 'date', t_misc.get_dateobj_from_yeardoy(term[1:5], term[5:8])
+        # Otherwise (substring)
+        return 'substring', term
+
+    # Check a date matches a date predicate
+    @staticmethod
+    def match_date(field, value, date):
+        # If the predicate is on the date
+        if field == 'date':
+            return date == value
+        # If the predicate is on the year
+        if field == 'year':
+            return date.year == value
+        # Otherwise (on the DOY)
+        return t_misc.get_doy_from_date(date) == value
+
+    # Check a year could have files passing the filter (includes are all required)
+    def check_year(self, year):
+        # For each inclusion
+        for field, value in self.include:
+            # If the predicate requires a different year
+            if (field == 'year' and value != year) or (field == 'date' and value.year != year):
+                return False
+        # For each exclusion
+        for field, value in self.exclude:
+            # If the predicate excludes the whole year
+            if field == 'year' and value == year:
+                return False
+        # Passed
+        return True
+
+    # Check a date could have files passing the filter
+    def check_date(self, date):
+        # For each inclusion
+        for field, value in self.include:
+            # If the predicate requires a different date
+            if field in ['date', 'year', 'doy'] and not self.match_date(field, value, date):
+                return False
+        # For each exclusion
+        for field, value in self.exclude:
+            # If the predicate excludes the date
+            if field in ['date', 'year', 'doy'] and self.match_date(field, value, date):
+                return False
+        # Passed
+        return True
+
+    # Filter a list of file names (vectorized), returning those that pass
+    def filter_names(self, filenames):
+        # If there are no predicates
+        if not self.include and not self.exclude:
+            # All pass
+            return filenames
+        # Array of the file names
+        names = np.array(filenames, dtype=np.str_)
+        # Mask of the names that pass
+        mask = np.ones(len(names), dtype=bool)
+        # Years and DOYs of the names, and their parsed fields (each parsed once, if needed)
+        years_doys = None
+        parsed = None
+        # For each predicate and whether it is an exclusion
+        for exclusion, (field, value) in [(False, term) for term in self.include] + \
+                                         [(True, term) for term in self.exclude]:
+            # If the predicate is on a date field
+            if field in ['date', 'year', 'doy']:
+                # If the years and DOYs have not been parsed
+                if years_doys is None:
+                    years_doys = LAADSCatalog.get_years_doys_from_ordinals(
+                        LAADSCatalog.get_ordinals_from_filenames(np.char.encode(names)))
+                # Match the field
+                if field == 'date':
+                    match = (years_doys[0] == value.year) & (years_doys[1] == t_misc.get_doy_from_date(value))
+                elif field == 'year':
+                    match = years_doys[0] == value
+                else:
+                    match = years_doys[1] == value
+            # If the predicate is on a named field (product, tile or collection)
+            elif field in ['product', 'tile', 'collection']:
+                # If the names have not been parsed
+                if parsed is None:
+                    parsed = [t_laads.parse_filename(name) for name in filenames]
+                # Match the field exactly (so a tile does not match a collection predicate)
+                match = np.array([fields is not None and getattr(fields, field) == value for fields in parsed],
+                                 dtype=bool)
+            # Otherwise (substring)
+            else:
+                match = np.char.find(names, value) >= 0
+            # Apply to the mask
+            mask &= ~match if exclusion else match
+        # Return the names that passed
+        return names[mask].tolist()
+
+
+# Columnar (NumPy-backed) catalog of files, sorted by date and then file name
+class LAADSCatalog:
+
+    def __init__(self, filenames, hashes, dates=None):
+
+        # Fixed-width byte strings for the file names
+        names = np.array(filenames, dtype=np.bytes_)
+        # If the date ordinals were not provided
+        if dates is None:
+            # Parse them from the file names
+            dates = self.get_ordinals_from_filenames(names)
+        # Date ordinals
+        dates = np.array(dates, dtype=np.int32)
+        # MD5 hashes as 16 bytes per file
+        hashes = self.get_hash_bytes(hashes)
+        # Sort by date, then file name
+        order = np.lexsort((names, dates))
+        self.names = names[order]
+        self.dates = dates[order]
+        self.hashes = hashes[order]
+        # Order of the files by name (for file name lookups)
+        self.name_order = np.argsort(self.names, kind='stable')
+        # Unique dates and the index of their first file
+        self.unique_dates, self.date_starts = np.unique(self.dates, return_index=True)
+
+        # Lazy views in the format of the original indexing dictionaries
+        self.by_filename = LAADSCatalogByFilename(self)
+        self.by_date = LAADSCatalogByDate(self)
+        self.by_year_doy = LAADSCatalogByYearDOY(self)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Get date ordinals from an array of LAADS file names (vectorized)
+    @staticmethod
+    def get_ordinals_from_filenames(names):
+        # Empty array for the ordinals
+        ordinals = np.zeros(len(names), dtype=np.int32)
+        # If there are no names
+        if len(names) == 0:
+            # Return the empty array
+            return ordinals
+        # Position of the ".AYYYYDDD" date string in each name
+        offsets = np.char.find(names, b'.A')
+        # View the names as a 2D array of characters
+        chars = names.view(np.uint8).reshape(len(names), names.itemsize)
+        # For each distinct date position (one per product, in practice)
+        for offset in np.unique(offsets):
+            # If the name has no date string
+            if offset < 0:
+                # Log a warning
+                logging.warning(f'{np.count_nonzero(offsets == offset)} file names have no acquisition date.')
+                # Skip them
+                continue
+            # Rows with the date at this position
+            rows = offsets == offset
+            # Digits of the year and DOY
+            digits = chars[rows, offset + 2:offset + 9].astype(np.int32) - ord('0')
+            year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+            doy = digits[:, 4] * 100 + digits[:, 5] * 10 + digits[:, 6]
+            # Ordinal of the date (ordinal of Jan 1st of the year, plus the DOY - 1)
+            prev_year = year - 1
+            ordinals[rows] = prev_year * 365 + prev_year // 4 - prev_year // 100 + prev_year // 400 + doy
+        # Return the ordinals
+        return ordinals
+
+    # Get (years, DOYs) arrays from an array of date ordinals (vectorized)
+    @staticmethod
+    def get_years_doys_from_ordinals(ordinals):
+        # Dates as NumPy dates (ordinal 719163 is 1970-01-01)
+        dates = (np.asarray(ordinals) - 719163).astype('datetime64[D]')
+        # Return the years and DOYs
+        return (dates.astype('datetime64[Y]').astype(np.int32) + 1970,
+                (dates - dates.astype('datetime64[Y]')).astype(np.int32) + 1)
+
+    # Convert hexadecimal MD5 hashes to a (n, 16) array of bytes (vectorized)
+    @staticmethod
+    def get_hash_bytes(hashes):
+        # If the hashes are already an array of bytes (e.g. from another catalog)
+        if isinstance(hashes, np.ndarray) and hashes.dtype == np.uint8 and hashes.ndim == 2:
+            # Return them
+            return hashes
+        # Fixed-width hexadecimal characters (missing hashes are empty)
+        hex_chars = np.array([file_hash or '' for file_hash in hashes], dtype='S32')
+        # If there are no hashes
+        if len(hex_chars) == 0:
+            # Return an empty array
+            return np.zeros((0, 16), dtype=np.uint8)
+        # View as a 2D array of characters
+        chars = hex_chars.view(np.uint8).reshape(len(hex_chars), 32).astype(np.int16)
+        # Convert the characters to 4-bit values
+        nibbles = np.where(chars >= ord('a'), chars - ord('a') + 10,
+                           np.where(chars >= ord('A'), chars - ord('A') + 10, chars - ord('0')))
+        # Missing characters are zero
+        nibbles[chars == 0] = 0
+        # Combine pairs of nibbles into bytes
+        return (nibbles[:, 0::2] * 16 + nibbles[:, 1::2]).astype(np.uint8)
+
+    # Get the index of a file name (or None if it is not in the catalog)
+    def get_index(self, filename):
+        # Encode the file name
+        key = filename.encode() if isinstance(filename, str) else filename
+        # If the name cannot be in the array
+        if not isinstance(key, bytes) or len(key) > self.names.itemsize or len(self.names) == 0:
+            # Return None
+            return None
+        # Find the position in name order
+        position = np.searchsorted(self.names, key, sorter=self.name_order)
+        # If the name was not found
+        if position == len(self.names) or self.names[self.name_order[position]] != key:
+            # Return None
+            return None
+        # Return the index
+        return int(self.name_order[position])
+
+    # Get the slice of files for a date (or None if there are none)
+    def get_date_slice(self, date):
+        # If the key is not a date
+        if not isinstance(date, datetime.date):
+            # Return None
+            return None
+        # Find the position of the date
+        position = np.searchsorted(self.unique_dates, date.toordinal())
+        # If the date was not found
+        if position == len(self.unique_dates) or self.unique_dates[position] != date.toordinal():
+            # Return None
+            return None
+        # Return the slice of files for the date
+        return slice(int(self.date_starts[position]), self.get_date_end(position))
+
+    # Get the slice of files dated from a start date to an end date (inclusive, and empty if there are none)
+    def get_date_range_slice(self, start_date, end_date):
+        # Find the first file on or after the start date, and the first file after the end date
+        start = np.searchsorted(self.dates, start_date.toordinal(), side='left')
+        end = np.searchsorted(self.dates, end_date.toordinal(), side='right')
+        # Return the slice of files in the range
+        return slice(int(start), int(max(start, end)))
+
+    # Get the end index of the files for a position in the unique dates
+    def get_date_end(self, position):
+        # If this is the last date
+        if position + 1 == len(self.date_starts):
+            # Return the number of files
+            return len(self.names)
+        # Return the start of the next date
+        return int(self.date_starts[position + 1])
+
+    # Get the hash of a file at an index (or None if there was no hash)
+    def get_hash(self, index):
+        # Reference the hash bytes
+        hash_bytes = self.hashes[index]
+        # If there was no hash
+        if not hash_bytes.any():
+            # Return None
+            return None
+        # Return as hexadecimal
+        return hash_bytes.tobytes().hex()
+
+    # Materialize a LAADSFile object for a file at an index
+    def get_file(self, index):
+        return LAADSFile(self.names[index].decode(),
+                         datetime.date.fromordinal(int(self.dates[index])),
+                         self.get_hash(index))
+
+    # Materialize LAADSFile objects for a slice of files
+    def get_files(self, file_slice):
+        return [self.get_file(index) for index in range(file_slice.start, file_slice.stop)]
+
+
+# Lazy view of a LAADSCatalog by file name (file name: LAADSFile)
+class LAADSCatalogByFilename(Mapping):
+
+    def __init__(self, catalog):
+
+        self.catalog = catalog
+
+    def __getitem__(self, filename):
+        # Get the index of the file
+        index = self.catalog.get_index(filename)
+        # If the file is not in the catalog
+        if index is None:
+            raise KeyError(filename)
+        # Return the file object
+        return self.catalog.get_file(index)
+
+    def __contains__(self, filename):
+        return self.catalog.get_index(filename) is not None
+
+    def __iter__(self):
+        return (name.decode() for name in self.catalog.names)
+
+    def __len__(self):
+        return len(self.catalog.names)
+
+
+# Lazy view of a LAADSCatalog by date (datetime date: list of LAADSFile)
+class LAADSCatalogByDate(Mapping):
+
+    def __init__(self, catalog):
+
+        self.catalog = catalog
+
+    def __getitem__(self, date):
+        # Get the slice of files for the date
+        file_slice = self.catalog.get_date_slice(date)
+        # If the date is not in the catalog
+        if file_slice is None:
+            raise KeyError(date)
+        # Return the file objects
+        return self.catalog.get_files(file_slice)
+
+    def __contains__(self, date):
+        return self.catalog.get_date_slice(date) is not None
+
+    def __iter__(self):
+        return (datetime.date.fromordinal(int(ordinal)) for ordinal in self.catalog.unique_dates)
+
+    def __len__(self):
+        return len(self.catalog.unique_dates)
+
+
+# Lazy view of a LAADSCatalog by year and DOY (year string: {zero-padded DOY string: list of LAADSFile})
+class LAADSCatalogByYearDOY(Mapping):
+
+    def __init__(self, catalog):
+
+        self.catalog = catalog
+        # Year and DOY of each unique date
+        self.years, self.doys = LAADSCatalog.get_years_doys_from_ordinals(self.catalog.unique_dates)
+
+    def __getitem__(self, year):
+        # Positions of the unique dates in the year
+        try:
+            positions = np.flatnonzero(self.years == int(year))
+        except (TypeError, ValueError):
+            raise KeyError(year)
+        # If the year is not in the catalog
+        if len(positions) == 0:
+            raise KeyError(year)
+        # Return a view of the year
+        return LAADSCatalogByDOY(self.catalog, positions, self.doys[positions])
+
+    def __iter__(self):
+        return (str(year) for year in np.unique(self.years))
+
+    def __len__(self):
+        return len(np.unique(self.years))
+
+
+# Lazy view of one year of a LAADSCatalog by DOY (zero-padded DOY string: list of LAADSFile)
+class LAADSCatalogByDOY(Mapping):
+
+    def __init__(self, catalog, positions, doys):
+
+        self.catalog = catalog
+        # Positions in the catalog's unique dates, and their DOYs
+        self.positions = positions
+        self.doys = doys
+
+    def __getitem__(self, doy):
+        # Find the DOY
+        try:
+            matches = np.flatnonzero(self.doys == int(doy))
+        except (TypeError, ValueError):
+            raise KeyError(doy)
+        # If the DOY is not in the year
+        if len(matches) == 0:
+            raise KeyError(doy)
+        # Position in the unique dates
+        position = int(self.positions[matches[0]])
+        # Return the file objects
+        return self.catalog.get_files(slice(int(self.catalog.date_starts[position]),
+                                            self.catalog.get_date_end(position)))
+
+    def __iter__(self):
+        return (t_misc.zero_pad_number(doy, digits=3) for doy in self.doys)
+
+    def __len__(self):
+        return len(self.doys)
+
+
 class LAADSFile:
 
     def __init__(self, file_name, date, hash):
@@ -0,0 +1,249 @@
+import sqlite3
+import threading
+import datetime
+import json
+import logging
+from os import environ
+from pathlib import Path
+from time import time
+
+
+# Schema for the directory listing cache
+CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS listings (
+    url TEXT PRIMARY KEY,
+    level TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    fetched REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS listings_by_accessed ON listings (accessed);
+'''
+
+# Default time to live (seconds) for each level of listing, before it is revalidated with LAADS
+# ('historical' is for year and DOY listings older than historical_days, which essentially never change)
+CACHE_TTL = {'product': 24 * 3600,
+             'year': 24 * 3600,
+             'doy': 12 * 3600,
+             'historical': 90 * 24 * 3600}
+
+# Default size cap for the cache (bytes)
+CACHE_MAX_BYTES = 1024 ** 3
+
+
+# Class for a persistent cache of LAADS directory listings (JSON), with conditional revalidation and LRU eviction
+class LAADSJsonCache:
+
+    def __init__(self, cache_path=None, ttl=None, max_bytes=CACHE_MAX_BYTES, historical_days=60):
+
+        # If no path was provided
+        if not cache_path:
+            # Use the default cache in the support directory
+            cache_path = Path(environ['support_dir'], 'laads_json_cache.sqlite')
+        self.cache_path = cache_path
+        # Time to live for each level (defaults, updated with any provided)
+        self.ttl = dict(CACHE_TTL)
+        self.ttl.update(ttl if ttl else {})
+        self.max_bytes = max_bytes
+        self.historical_days = historical_days
+        # One connection per thread
+        self.local = threading.local()
+        # Lock for eviction
+        self.lock = threading.Lock()
+        # Current size of the cache
+        self.size = self.get_connection().execute('SELECT COALESCE(SUM(size), 0) FROM listings').fetchone()[0]
+
+    # Get the connection for the current thread
+    def get_connection(self):
+        # If the thread does not have a connection yet
+        if not hasattr(self.local, 'connection'):
+            # Open the connection (waiting on other writers)
+            self.local.connection = sqlite3.connect(str(self.cache_path), timeout=60)
+            self.local.connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection.execute('PRAGMA synchronous=NORMAL')
+            # Make sure the table and index exist
+            self.local.connection.executescript(CACHE_SCHEMA)
+        # Return the connection
+        return self.local.connection
+
+    # Get the cache level of a listing URL ('product', 'year', 'doy' or 'historical')
+    def get_level(self, url):
+        # Parts of the URL below the archive (archive set, product, year, DOY)
+        parts = url.replace(environ['laads_alldata_url'], '').replace('.json', '').strip('/').split('/')
+        # If the year or DOY are not numbers
+        if not all(part.isdigit() for part in parts[2:]):
+            # Treat as a product (or other) listing
+            return 'product'
+        # If this is a year listing
+        if len(parts) == 3:
+            # If the year finished more than historical_days ago
+            if (datetime.date.today() - datetime.date(int(parts[2]), 12, 31)).days > self.historical_days:
+                return 'historical'
+            return 'year'
+        # If this is a DOY listing
+        if len(parts) == 4:
+            # If the DOY is more than historical_days ago
+            if (datetime.date.today() - datetime.date(int(parts[2]), 1, 1)).days - int(parts[3]) + 1 > \
+                    self.historical_days:
+                return 'historical'
+            return 'doy'
+        # Otherwise (product or other listing)
+        return 'product'
+
+    # Get a cached entry for a URL as (body, etag, last modified, fetched), or None
+    def get_entry(self, url):
+        return self.get_connection().execute('SELECT body, etag, last_modified, fetched FROM listings WHERE url = ?',
+                                             (url,)).fetchone()
+
+    # Mark an entry as used (and optionally as revalidated)
+    def touch(self, url, revalidated=False):
+        # Connection for the thread
+        connection = self.get_connection()
+        with connection:
+            # If revalidated with LAADS
+            if revalidated:
+                connection.execute('UPDATE listings SET accessed = ?, fetched = ? WHERE url = ?', (time(), time(), url))
+            else:
+                connection.execute('UPDATE listings SET accessed = ? WHERE url = ?', (time(), url))
+
+    # Get a listing if it is within its time to live (otherwise None)
+    def get_fresh(self, url):
+        # Get the entry
+        entry = self.get_entry(url)
+        # If there is no entry, or it has expired
+        if not entry or time() - entry[3] > self.ttl[self.get_level(url)]:
+            # Return None
+            return None
+        # Mark it as used
+        self.touch(url)
+        # Return the listing
+        return json.loads(entry[0])
+
+    # Get the headers for a conditional request for a URL (empty if there is no entry)
+    def get_conditional_headers(self, url):
+        # Headers
+        headers = {}
+        # Get the entry
+        entry = self.get_entry(url)
+        # If there is an entry
+        if entry:
+            # If there is an ETag
+            if entry[1]:
+                headers['If-None-Match'] = entry[1]
+            # If there is a last modified date
+            if entry[2]:
+                headers['If-Modified-Since'] = entry[2]
+        # Return the headers
+        return headers
+
+    # Get a listing that LAADS reported as not modified (or that is stale, if LAADS failed)
+    def get_cached(self, url, revalidated=True):
+        # Get the entry
+        entry = self.get_entry(url)
+        # If there is no entry
+        if not entry:
+            # Return None
+            return None
+        # Mark it as used
+        self.touch(url, revalidated=revalidated)
+        # Return the listing
+        return json.loads(entry[0])
+
+    # Store a listing from its content and response headers
+    def put(self, url, content, headers):
+        # Connection for the thread
+        connection = self.get_connection()
+        with connection:
+            # Size of any entry being replaced
+            replaced = connection.execute('SELECT size FROM listings WHERE url = ?', (url,)).fetchone()
+            # Store the entry
+            connection.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (url,
+                                self.get_level(url),
+                                headers.get('ETag'),
+                                headers.get('Last-Modified'),
+                                time(),
+                                time(),
+                                len(content),
+                                content))
+        # Update the size of the cache
+        with self.lock:
+            self.size += len(content) - (replaced[0] if replaced else 0)
+        # If the cache is over its cap
+        if self.size > self.max_bytes:
+            # Evict the least recently used entries
+            self.evict()
+
+    # Evict least recently used entries until the cache is under 90% of its cap
+    def evict(self):
+        # Only one thread evicts at a time
+        with self.lock:
+            # Connection for the thread
+            connection = self.get_connection()
+            # Bytes evicted
+            evicted = 0
+            # Entries to evict
+            urls = []
+            # For each entry, least recently used first
+            for url, size in connection.execute('SELECT url, size FROM listings ORDER BY accessed'):
+                # If enough has been evicted
+                if self.size - evicted <= self.max_bytes * 0.9:
+                    break
+                # Add to the entries to evict
+                urls.append((url,))
+                evicted += size
+            with connection:
+                connection.executemany('DELETE FROM listings WHERE url = ?', urls)
+            # Update the size of the cache
+            self.size -= evicted
+        # Log the info
+        logging.info(f'Evicted {len(urls)} listings ({evicted} bytes) from {self.cache_path}.')
+
+    # Get a listing through the cache with a requests session (see t_requests.ask_nicely for kwargs)
+    def get_json(self, session, url, ask_func, **kwargs):
+        # If there is a fresh listing
+        listing = self.get_fresh(url)
+        if listing is not None:
+            # Return it without a request
+            return listing
+        # Ask nicely with a conditional request
+        r = ask_func(session, url, headers=self.get_conditional_headers(url), ok_codes=(200, 304), **kwargs)
+        # If the request failed
+        if r is None:
+            # Get any stale listing
+            listing = self.get_cached(url, revalidated=False)
+            # If there was one
+            if listing is not None:
+                # Log a warning
+                logging.warning(f'Using stale cached listing for {url}.')
+            # Return the stale listing (or None)
+            return listing
+        # If the listing was not modified
+        if r.status_code == 304:
+            # Return the cached listing
+            return self.get_cached(url)
+        # Store the listing
+        self.put(url, r.content, r.headers)
+        # Return the listing
+        return r.json()
+
+
+# Shared cache for the process
+json_cache = None
+# Lock for creating the shared cache
+json_cache_lock = threading.Lock()
+
+
+# Get the shared listing cache for the process
+def get_json_cache():
+    global json_cache
+    with json_cache_lock:
+        # If there is no cache yet
+        if json_cache is None:
+            # Create it
+            json_cache = LAADSJsonCache()
+    # Return the cache
+    return json_cache
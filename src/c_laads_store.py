@@ -0,0 +1,362 @@
+import sqlite3
+import datetime
+import json
+import logging
+from os import environ
+from pathlib import Path
+
+
+# Schema for the support store
+STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datasets (
+    name TEXT PRIMARY KEY,
+    archive_set TEXT,
+    product TEXT,
+    start_date TEXT,
+    end_date TEXT,
+    include TEXT,
+    exclude TEXT
+);
+CREATE INDEX IF NOT EXISTS datasets_by_product ON datasets (product);
+CREATE TABLE IF NOT EXISTS catalogs (
+    catalog_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dataset TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS catalogs_by_dataset ON catalogs (dataset, created);
+CREATE TABLE IF NOT EXISTS files (
+    catalog_id INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    md5 TEXT,
+    PRIMARY KEY (catalog_id, filename)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_by_date ON files (catalog_id, date);
+CREATE TABLE IF NOT EXISTS downloads (
+    dataset TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    attempted TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS downloads_by_file ON downloads (dataset, filename, status);
+CREATE TABLE IF NOT EXISTS download_status (
+    dataset TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_attempted TEXT NOT NULL,
+    PRIMARY KEY (dataset, filename)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS superseded (
+    dataset TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    replaced_by TEXT,
+    removed INTEGER NOT NULL,
+    recorded TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS superseded_by_file ON superseded (dataset, filename);
+CREATE TABLE IF NOT EXISTS verified_files (
+    path TEXT PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    verified TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS verified_files_by_dataset ON verified_files (dataset);
+'''
+
+# Format for timestamps in the store (sorts chronologically as text)
+STORE_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Catalogs are identified by their timestamps, so these are stored with microseconds (in ISO format with a space, which
+# leaves them out when they are zero, so catalogs stored to the second still match, and still sorts as text)
+CATALOG_DATETIME_SEP = ' '
+
+# Download attempts in the journal for a dataset before it is compacted (see compact_downloads)
+COMPACT_DOWNLOADS_ROWS = 1000000
+
+
+# Class for the SQLite store of dataset specifications, catalogs and download attempts (in support_dir)
+class LAADSStore:
+
+    def __init__(self, store_path=None):
+
+        # If no path was provided
+        if not store_path:
+            # Use the default store in the support directory
+            store_path = Path(environ['support_dir'], 'laads_store.sqlite')
+        self.store_path = store_path
+        # Open the connection (waiting on other processes that hold the write lock)
+        self.connection = sqlite3.connect(str(self.store_path), timeout=60)
+        # Write-ahead logging so readers in other processes are not blocked by a writer
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # Make sure the tables and indexes exist
+        self.connection.executescript(STORE_SCHEMA)
+        self.connection.commit()
+        # If there are download attempts, but no snapshot of them (a store from before the snapshot)
+        if self.connection.execute('SELECT 1 FROM downloads LIMIT 1').fetchone() and \
+                not self.connection.execute('SELECT 1 FROM download_status LIMIT 1').fetchone():
+            # Build the snapshot
+            self.rebuild_download_status()
+
+    # Close the connection
+    def close(self):
+        self.connection.close()
+
+    # Get a dataset specification as a dictionary (or None if there is none)
+    def get_dataset(self, name):
+        # Query the dataset
+        row = self.connection.execute('SELECT name, archive_set, product, start_date, end_date, include, exclude '
+                                      'FROM datasets WHERE name = ?', (name,)).fetchone()
+        # If there is no dataset
+        if not row:
+            # Return None
+            return None
+        # Return a dictionary in the format of the specification files
+        return {'Name': row[0],
+                'Archive Set': row[1],
+                'Product': row[2],
+                'Start Date': row[3],
+                'End Date': row[4],
+                'Include': json.loads(row[5]),
+                'Exclude': json.loads(row[6])}
+
+    # Store a dataset specification (dictionary in the format of the specification files)
+    def put_dataset(self, spec_dict):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (spec_dict['Name'],
+                                     spec_dict['Archive Set'],
+                                     spec_dict['Product'],
+                                     spec_dict['Start Date'],
+                                     spec_dict['End Date'],
+                                     json.dumps(spec_dict['Include']),
+                                     json.dumps(spec_dict['Exclude'])))
+
+    # Get the datetime of the latest catalog for a dataset (or None if there is none)
+    def get_latest_catalog_datetime(self, dataset):
+        # Query the latest catalog
+        row = self.connection.execute('SELECT created FROM catalogs WHERE dataset = ? '
+                                      'ORDER BY created DESC, catalog_id DESC LIMIT 1', (dataset,)).fetchone()
+        # If there is no catalog
+        if not row:
+            # Return None
+            return None
+        # Return the datetime
+        return datetime.datetime.fromisoformat(row[0])
+
+    # Get the datetimes of all catalogs for a dataset, oldest first
+    def get_catalog_datetimes(self, dataset):
+        return [datetime.datetime.fromisoformat(row[0]) for row in
+                self.connection.execute('SELECT DISTINCT created FROM catalogs WHERE dataset = ? ORDER BY created',
+                                        (dataset,))]
+
+    # Get the ID of a catalog for a dataset by its datetime (or None if there is none)
+    def get_catalog_id(self, dataset, catalog_datetime):
+        # Query the catalog
+        row = self.connection.execute('SELECT MAX(catalog_id) FROM catalogs WHERE dataset = ? AND created = ?',
+                                      (dataset, catalog_datetime.isoformat(sep=CATALOG_DATETIME_SEP))).fetchone()
+        # Return the ID
+        return row[0]
+
+    # Store a new catalog for a dataset from a dictionary of file names and hashes
+    def put_catalog(self, dataset, file_dict, date_func, catalog_datetime=None):
+        # If no datetime was provided
+        if not catalog_datetime:
+            # Use now
+            catalog_datetime = datetime.datetime.now()
+        with self.connection:
+            # Insert the catalog
+            cursor = self.connection.execute('INSERT INTO catalogs (dataset, created) VALUES (?, ?)',
+                                             (dataset, catalog_datetime.isoformat(sep=CATALOG_DATETIME_SEP)))
+            # Reference the new catalog ID
+            catalog_id = cursor.lastrowid
+            # Insert the files
+            self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                        ((catalog_id, filename, date_func(filename).toordinal(), md5)
+                                         for filename, md5 in file_dict.items()))
+        # Return the datetime of the catalog
+        return catalog_datetime
+
+    # Get a catalog for a dataset as a dictionary of file names and hashes
+    def get_catalog(self, dataset, catalog_datetime):
+        # Get the catalog ID
+        catalog_id = self.get_catalog_id(dataset, catalog_datetime)
+        # Return the files, in date order
+        return dict(self.connection.execute('SELECT filename, md5 FROM files WHERE catalog_id = ? '
+                                            'ORDER BY date, filename', (catalog_id,)))
+
+    # Iterate over a catalog for a dataset as (file name, hash) tuples, without loading it all
+    def iter_catalog(self, dataset, catalog_datetime):
+        # Get the catalog ID
+        catalog_id = self.get_catalog_id(dataset, catalog_datetime)
+        # Open a separate cursor, so the catalog can be streamed alongside other queries
+        cursor = self.connection.cursor()
+        # Yield the files as they are read
+        yield from cursor.execute('SELECT filename, md5 FROM files WHERE catalog_id = ?', (catalog_id,))
+
+    # Get a catalog for a dataset as columns (file names, date ordinals, hashes)
+    def get_catalog_columns(self, dataset, catalog_datetime):
+        # Get the catalog ID
+        catalog_id = self.get_catalog_id(dataset, catalog_datetime)
+        # Get the rows
+        rows = self.connection.execute('SELECT filename, date, md5 FROM files WHERE catalog_id = ?',
+                                       (catalog_id,)).fetchall()
+        # If there are no rows
+        if not rows:
+            # Return empty columns
+            return [], [], []
+        # Return the columns
+        return tuple(list(column) for column in zip(*rows))
+
+    # Check if a dataset has any download attempts
+    def has_downloads(self, dataset):
+        return self.connection.execute('SELECT 1 FROM download_status WHERE dataset = ? LIMIT 1',
+                                       (dataset,)).fetchone() is not None
+
+    # Record download attempts for a dataset from an iterable of (file name, status) tuples: appended to the journal
+    # (downloads) and folded into the snapshot of the latest status for each file (download_status), in one batch
+    def add_downloads(self, dataset, results, attempted=None):
+        # If no attempt datetime was provided
+        if not attempted:
+            # Use now
+            attempted = datetime.datetime.now()
+        # Convert to string
+        attempted = attempted.strftime(STORE_DATETIME_FORMAT)
+        # Rows of the attempts
+        rows = [(dataset, filename, int(bool(status)), attempted) for filename, status in results]
+        with self.connection:
+            # Append to the journal
+            self.connection.executemany('INSERT INTO downloads VALUES (?, ?, ?, ?)', rows)
+            # Make sure each file is in the snapshot
+            self.connection.executemany('INSERT OR IGNORE INTO download_status VALUES (?, ?, 0, 0, ?)',
+                                        ((dataset, filename, attempted) for dataset, filename, status, attempted
+                                         in rows))
+            # Update the snapshot with the latest status
+            self.connection.executemany('UPDATE download_status SET status = ?, attempts = attempts + 1, '
+                                        'last_attempted = ? WHERE dataset = ? AND filename = ?',
+                                        ((status, attempted, dataset, filename) for dataset, filename, status, attempted
+                                         in rows))
+
+    # Remove the download attempts for files of a dataset from the journal and the snapshot (e.g. local copies that were
+    # removed), so the files are no longer recorded as downloaded
+    def remove_downloads(self, dataset, filenames):
+        # Rows of the files
+        rows = [(dataset, filename) for filename in filenames]
+        with self.connection:
+            self.connection.executemany('DELETE FROM downloads WHERE dataset = ? AND filename = ?', rows)
+            self.connection.executemany('DELETE FROM download_status WHERE dataset = ? AND filename = ?', rows)
+
+    # Get the download record for a dataset (True if the latest attempt for a file succeeded), from the snapshot
+    def get_download_record(self, dataset):
+        return {filename: bool(status) for filename, status in
+                self.connection.execute('SELECT filename, status FROM download_status WHERE dataset = ?',
+                                        (dataset,))}
+
+    # Rebuild the snapshot of the latest download status for each file from the journal
+    def rebuild_download_status(self):
+        # Log the info
+        logging.info(f'Building the download status snapshot in {self.store_path}.')
+        with self.connection:
+            # Clear the snapshot
+            self.connection.execute('DELETE FROM download_status')
+            # Fold the journal into the snapshot (the latest attempt wins, in the order they were recorded)
+            self.connection.execute('INSERT INTO download_status '
+                                    'SELECT dataset, filename, '
+                                    '(SELECT latest.status FROM downloads AS latest '
+                                    'WHERE latest.dataset = downloads.dataset AND latest.filename = downloads.filename '
+                                    'ORDER BY latest.attempted DESC, latest.rowid DESC LIMIT 1), '
+                                    'COUNT(*), MAX(attempted) FROM downloads GROUP BY dataset, filename')
+
+    # Compact the download journal for a dataset if it has more than max_rows attempts, keeping only the latest attempt
+    # for each file (in the order the snapshot is rebuilt), so a rebuild still gives each file its latest status.
+    # Returns True if it was compacted.
+    def compact_downloads(self, dataset, max_rows=COMPACT_DOWNLOADS_ROWS):
+        # Count the attempts in the journal
+        rows = self.connection.execute('SELECT COUNT(*) FROM downloads WHERE dataset = ?', (dataset,)).fetchone()[0]
+        # If there are not too many
+        if rows <= max_rows:
+            # Return False
+            return False
+        # Log the info
+        logging.info(f'Compacting {rows} download attempts for {dataset} in {self.store_path}.')
+        with self.connection:
+            # Delete every attempt but the latest for each file of the dataset
+            self.connection.execute('DELETE FROM downloads WHERE dataset = ? AND rowid NOT IN '
+                                    '(SELECT (SELECT latest.rowid FROM downloads AS latest '
+                                    'WHERE latest.dataset = files.dataset AND latest.filename = files.filename '
+                                    'ORDER BY latest.attempted DESC, latest.rowid DESC LIMIT 1) '
+                                    'FROM downloads AS files WHERE files.dataset = ? GROUP BY files.filename)',
+                                    (dataset, dataset))
+        # Return True
+        return True
+
+    # Record superseded files for a dataset from an iterable of (file name, replaced by) tuples
+    def add_superseded(self, dataset, superseded, removed=False):
+        # Recorded datetime string
+        recorded = datetime.datetime.now().strftime(STORE_DATETIME_FORMAT)
+        with self.connection:
+            self.connection.executemany('INSERT INTO superseded VALUES (?, ?, ?, ?, ?)',
+                                        ((dataset, filename, replaced_by, int(removed), recorded)
+                                         for filename, replaced_by in superseded))
+
+    # Get the ledger of verified files for a dataset as a dictionary of paths to (size, mtime_ns, inode, md5) tuples
+    def get_verified_files(self, dataset):
+        return {row[0]: tuple(row[1:]) for row in
+                self.connection.execute('SELECT path, size, mtime_ns, inode, md5 FROM verified_files '
+                                        'WHERE dataset = ?', (dataset,))}
+
+    # Record verified files for a dataset from an iterable of (path, size, mtime_ns, inode, md5) tuples
+    def put_verified_files(self, dataset, verified_files):
+        # Verified datetime string
+        verified = datetime.datetime.now().strftime(STORE_DATETIME_FORMAT)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO verified_files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        ((str(path), dataset, size, mtime_ns, inode, md5, verified)
+                                         for path, size, mtime_ns, inode, md5 in verified_files))
+
+    # Remove files from the ledger of verified files by path
+    def remove_verified_files(self, paths):
+        with self.connection:
+            self.connection.executemany('DELETE FROM verified_files WHERE path = ?', ((str(path),) for path in paths))
+
+    # Import a legacy JSON dataset specification file
+    def import_legacy_dataset(self, spec_path):
+        # Log the info
+        logging.info(f'Importing legacy dataset specification {spec_path} to {self.store_path}.')
+        # Open the file
+        with open(spec_path, 'r') as f:
+            # Store the dictionary
+            self.put_dataset(json.load(f))
+
+    # Import a legacy JSON catalog file
+    def import_legacy_catalog(self, dataset, catalog_path, catalog_datetime, date_func):
+        # Log the info
+        logging.info(f'Importing legacy catalog {catalog_path} to {self.store_path}.')
+        # Open the file
+        with open(catalog_path, 'r') as f:
+            # Store the catalog
+            self.put_catalog(dataset, json.load(f), date_func, catalog_datetime=catalog_datetime)
+
+    # Import a legacy text download record file
+    def import_legacy_downloads(self, dataset, download_path, download_datetime):
+        # Log the info
+        logging.info(f'Importing legacy download record {download_path} to {self.store_path}.')
+        # List of results
+        results = []
+        # Open the file
+        with open(download_path, 'r') as f:
+            # For each line
+            for line in f:
+                # Split the line on the space
+                split_line = line.strip().split(' ')
+                # If the line is not a file name and a status
+                if len(split_line) != 2:
+                    # Skip it
+                    continue
+                # Add the file name and status
+                results.append((split_line[0], split_line[1] == 'True'))
+        # Store the results
+        self.add_downloads(dataset, results, attempted=download_datetime)
@@ -0,0 +1,89 @@
+import numpy as np
+from pathlib import Path
+
+
+# Class for a plan of symbolic links for MCD43GF target years as compact arrays (one row per link), sorted by target
+# year, band, dataset and file. Each link is <dest_dir>/<target year>/<band>/<year of the file>/<file name>, pointing
+# to the file in the dataset's download directory (see get_file_path). See t_mcd43gf.plan_symbolic_links.
+class LinkPlan:
+
+    def __init__(self, datasets, dataset_indices, file_indices, target_years, bands, file_years):
+
+        # List of LAADSDataSet objects (the dataset indices refer to it)
+        self.datasets = datasets
+        # Sort the links by target year, band, dataset and file
+        order = np.lexsort((file_indices, dataset_indices, bands, target_years))
+        # Index of each link's dataset, and of its file in the dataset's catalog
+        self.dataset_indices = np.asarray(dataset_indices, dtype=np.uint16)[order]
+        self.file_indices = np.asarray(file_indices, dtype=np.int32)[order]
+        # Target year, band and year of the file for each link
+        self.target_years = np.asarray(target_years, dtype=np.int16)[order]
+        self.bands = np.asarray(bands, dtype=np.uint8)[order]
+        self.file_years = np.asarray(file_years, dtype=np.int16)[order]
+
+    def __len__(self):
+        return len(self.file_indices)
+
+    # Get the partitions of the plan as a list of ((target year, band), slice of links) tuples
+    def get_partitions(self):
+        # If there are no links
+        if len(self) == 0:
+            return []
+        # Positions where the target year or band changes (the links are sorted by them)
+        changes = np.flatnonzero((np.diff(self.target_years) != 0) | (np.diff(self.bands) != 0)) + 1
+        # Starts and ends of the partitions
+        starts = np.concatenate(([0], changes))
+        ends = np.concatenate((changes, [len(self)]))
+        # Return the partitions
+        return [((int(self.target_years[start]), int(self.bands[start])), slice(int(start), int(end)))
+                for start, end in zip(starts, ends)]
+
+    # Get the file name of a link
+    def get_filename(self, index):
+        return self.datasets[self.dataset_indices[index]].catalog.names[self.file_indices[index]].decode()
+
+    # Get the date ordinals of the files for a slice of links
+    def get_dates(self, link_slice):
+        # Empty array for the ordinals
+        dates = np.zeros(link_slice.stop - link_slice.start, dtype=np.int32)
+        # Dataset and file indices of the links
+        dataset_indices = self.dataset_indices[link_slice]
+        file_indices = self.file_indices[link_slice]
+        # For each dataset in the slice
+        for dataset_index in np.unique(dataset_indices):
+            # Links to the dataset's files
+            rows = dataset_indices == dataset_index
+            # Get their dates from the catalog
+            dates[rows] = self.datasets[dataset_index].catalog.dates[file_indices[rows]]
+        # Return the ordinals
+        return dates
+
+    # Get a list of (file path, link path) tuples for a slice of links
+    def get_link_paths(self, dest_dir, link_slice):
+        # List of paths
+        link_paths = []
+        # For each link in the slice
+        for index in range(link_slice.start, link_slice.stop):
+            # File name
+            filename = self.get_filename(index)
+            # Add the path to the file, and the path to the link
+            link_paths.append((self.datasets[self.dataset_indices[index]].get_file_path(filename),
+                               Path(dest_dir, str(self.target_years[index]), f'{self.bands[index]:02d}',
+                                    str(self.file_years[index]), filename)))
+        # Return the paths
+        return link_paths
+
+    # Get a dictionary of the link directories for a slice of links to dictionaries of their link names to file paths
+    def get_directory_links(self, dest_dir, link_slice):
+        # Dictionary of directories
+        directory_links = {}
+        # For each file path and link path
+        for file_path, link_path in self.get_link_paths(dest_dir, link_slice):
+            # Add the link name and the file path (as a string, as read back from a link) to its directory
+            directory_links.setdefault(link_path.parent, {})[link_path.name] = str(file_path)
+        # Return the directories
+        return directory_links
+
+    # Get the set of data products in the plan
+    def get_products(self):
+        return {dataset.product for dataset in self.datasets}
@@ -0,0 +1,153 @@
+import threading
+import struct
+import logging
+from os import environ, getpid, fdopen, O_RDWR, O_CREAT
+from os import open as os_open
+from pathlib import Path
+from time import time, sleep
+# File locks for sharing the buckets between processes (not available on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Layout of the shared state file (request tokens, byte tokens, time of the last update)
+STATE_FORMAT = '3d'
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+
+
+# Class for token bucket limits on requests per second and bytes per second, shared by every process on the host
+# through a state file under a file lock. Each request reserves its tokens up front (so the buckets can go into debt)
+# and then waits out any debt outside the lock, so waiting processes are served in order without polling.
+class TokenBucketRateLimiter:
+
+    def __init__(self, requests_per_second=None, bytes_per_second=None, burst_seconds=1, state_path=None):
+
+        # If no path was provided
+        if not state_path:
+            # Use the default state file in the support directory
+            state_path = Path(environ['support_dir'], 'laads_rate_limit.bin')
+        self.state_path = state_path
+        # Rates (None for no limit)
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+        # Bucket capacities (how much can be used at once after being idle)
+        self.burst_seconds = burst_seconds
+        # Lock for threads in the process (the file lock does not separate threads sharing a file)
+        self.lock = threading.Lock()
+        # State file (opened on first use, and again in a forked process)
+        self.state_file = None
+        self.pid = None
+        # If there are no file locks
+        if fcntl is None:
+            # Log a warning
+            logging.warning('File locks are not available. Rate limits will only apply within this process.')
+
+    # Get the capacity of a bucket from its rate
+    def get_capacity(self, rate):
+        return rate * self.burst_seconds if rate else 0
+
+    # Open the state file for the process
+    def open_state_file(self):
+        # If the file was not opened by this process
+        if self.pid != getpid():
+            # Open (or create) it without truncating
+            self.state_file = fdopen(os_open(self.state_path, O_RDWR | O_CREAT), 'r+b')
+            self.pid = getpid()
+        # Return the file
+        return self.state_file
+
+    # Update the shared buckets under the locks: refill them for the time passed, then take tokens for a request
+    # and its bytes. Returns the time to wait (seconds) until the buckets are out of debt.
+    def update(self, n_requests=0, n_bytes=0):
+        with self.lock:
+            # Open the state file
+            f = self.open_state_file()
+            # If there are file locks
+            if fcntl:
+                # Lock the file against other processes
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # Time now
+                now = time()
+                # Read the state
+                f.seek(0)
+                state = f.read(STATE_SIZE)
+                # If there is a state
+                if len(state) == STATE_SIZE:
+                    request_tokens, byte_tokens, last_update = struct.unpack(STATE_FORMAT, state)
+                # Otherwise (new state file)
+                else:
+                    # Start with full buckets
+                    request_tokens = self.get_capacity(self.requests_per_second)
+                    byte_tokens = self.get_capacity(self.bytes_per_second)
+                    last_update = now
+                # Time passed since the last update (never negative)
+                passed = max(0, now - last_update)
+                # Refill the buckets (up to their capacity) and take the tokens
+                if self.requests_per_second:
+                    request_tokens = min(self.get_capacity(self.requests_per_second),
+                                         request_tokens + passed * self.requests_per_second) - n_requests
+                if self.bytes_per_second:
+                    byte_tokens = min(self.get_capacity(self.bytes_per_second),
+                                      byte_tokens + passed * self.bytes_per_second) - n_bytes
+                # Write the state
+                f.seek(0)
+                f.truncate()
+                f.write(struct.pack(STATE_FORMAT, request_tokens, byte_tokens, now))
+                f.flush()
+            finally:
+                # If there are file locks
+                if fcntl:
+                    # Unlock the file
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        # Time to wait until both buckets are out of debt
+        wait = 0
+        if self.requests_per_second and request_tokens < 0:
+            wait = max(wait, -request_tokens / self.requests_per_second)
+        if self.bytes_per_second and byte_tokens < 0:
+            wait = max(wait, -byte_tokens / self.bytes_per_second)
+        # Return the time to wait
+        return wait
+
+    # Reserve a request, returning the time to wait (seconds) before making it (for callers that wait themselves)
+    def reserve(self):
+        return self.update(n_requests=1)
+
+    # Wait until a request can be made
+    def acquire(self):
+        # Reserve the request
+        wait = self.reserve()
+        # If there is debt to wait out
+        if wait > 0:
+            # Wait quietly and politely
+            sleep(wait)
+
+    # Take the bytes of a response (delaying later requests from every process if over the rate)
+    def consume_bytes(self, n_bytes):
+        # If there is a byte rate and bytes to take
+        if self.bytes_per_second and n_bytes:
+            self.update(n_bytes=n_bytes)
+
+
+# Shared rate limiter for LAADS requests in the process
+laads_rate_limiter = None
+# Lock for creating the shared rate limiter
+laads_rate_limiter_lock = threading.Lock()
+
+
+# Get the shared rate limiter for LAADS requests, set up from the laads_requests_per_second and laads_bytes_per_second
+# environment variables (e.g. in .env). Returns None if neither is set (no rate limit).
+def get_laads_rate_limiter():
+    global laads_rate_limiter
+    with laads_rate_limiter_lock:
+        # If there is no rate limiter yet, and there are rates
+        if laads_rate_limiter is None and (environ.get('laads_requests_per_second') or
+                                           environ.get('laads_bytes_per_second')):
+            # Create it
+            laads_rate_limiter = TokenBucketRateLimiter(
+                requests_per_second=float(environ.get('laads_requests_per_second') or 0) or None,
+                bytes_per_second=float(environ.get('laads_bytes_per_second') or 0) or None)
+    # Return the rate limiter (or None)
+    return laads_rate_limiter
@@ -0,0 +1,195 @@
+import threading
+import random
+import logging
+import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from time import monotonic
+
+
+# Status codes that will not change on a retry (so are not retried)
+NO_RETRY_CODES = (400, 401, 403, 404, 410)
+# Status codes that can come with a Retry-After header
+RETRY_AFTER_CODES = (429, 503)
+# Status codes that count as a failure of the host (for the circuit breaker)
+HOST_FAILURE_CODES = (500, 502, 503, 504)
+
+
+# Class for a retry policy shared between requests: exponential back-off with full jitter (or the server's
+# Retry-After), no retries on codes that will not change, a circuit breaker for each host (requests wait while it is
+# open, up to max_circuit_wait seconds), and a retry budget for the run (retries are allowed up to min_retries plus
+# budget_ratio of the requests made).
+class RetryPolicy:
+
+    def __init__(self,
+                 base_delay=1,
+                 max_delay=60,
+                 max_retry_after=300,
+                 no_retry_codes=NO_RETRY_CODES,
+                 circuit_failures=10,
+                 circuit_reset=60,
+                 circuit_poll=5,
+                 max_circuit_wait=600,
+                 budget_ratio=0.2,
+                 min_retries=100):
+
+        # Delay (seconds) before the first retry, doubling for each retry up to the max
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Longest Retry-After (seconds) that will be honored
+        self.max_retry_after = max_retry_after
+        self.no_retry_codes = no_retry_codes
+        # Consecutive failures that open a host's circuit, and seconds before a trial request is let through
+        self.circuit_failures = circuit_failures
+        self.circuit_reset = circuit_reset
+        # Seconds between checks of an open circuit, and the longest a request waits for one before failing
+        self.circuit_poll = circuit_poll
+        self.max_circuit_wait = max_circuit_wait
+        # Dictionary of hosts to their consecutive failures and the time their circuit opened (or None)
+        self.hosts = {}
+        # Retry budget
+        self.budget_ratio = budget_ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self.budget_spent = False
+        # Lock for the shared counts
+        self.lock = threading.Lock()
+
+    # Get the delay (seconds) before a retry (retry counts from 1), honoring any Retry-After (seconds) from the server
+    def get_delay(self, retry, retry_after=None):
+        # If the server said when to retry
+        if retry_after is not None:
+            # Honor it (up to the max)
+            return min(retry_after, self.max_retry_after)
+        # Exponential back-off with full jitter (spreads out retries from many workers)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+    # Get the Retry-After (seconds) from response headers, if there is one for the status code (otherwise None)
+    @staticmethod
+    def get_retry_after(status_code, headers):
+        # If the code does not come with a Retry-After, or there is none
+        if status_code not in RETRY_AFTER_CODES or not headers.get('Retry-After'):
+            return None
+        # Reference the value
+        retry_after = headers['Retry-After']
+        # Try to parse it as a number of seconds (e.g. 120 or 1.5)
+        try:
+            return max(0, float(retry_after))
+        # If it is not a number
+        except ValueError:
+            pass
+        # Otherwise, try to parse it as an HTTP date
+        try:
+            return max(0, (parsedate_to_datetime(retry_after) -
+                           datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        # If it is not parsable
+        except (TypeError, ValueError):
+            return None
+
+    # Check if a status code is worth retrying
+    def should_retry(self, status_code):
+        return status_code not in self.no_retry_codes
+
+    # Check if a request to a URL is allowed (counting it for the budget), or its host's circuit is open
+    def allow_request(self, url):
+        # Host of the URL
+        host = urlsplit(url).netloc
+        with self.lock:
+            # Get the host's failures and the time its circuit opened
+            failures, opened = self.hosts.get(host, (0, None))
+            # If the circuit is closed
+            if opened is None:
+                # Count the request
+                self.requests += 1
+                return True
+            # If the circuit has been open long enough
+            if monotonic() - opened > self.circuit_reset:
+                # Let a trial request through (half open), opening the circuit again for everything else
+                self.hosts[host] = (failures, monotonic())
+                # Count the request
+                self.requests += 1
+                return True
+        # Otherwise (the circuit is open)
+        return False
+
+    # Get the seconds to wait before checking an open circuit for a URL's host again (0 if it is closed or due a
+    # trial request)
+    def get_circuit_wait(self, url):
+        # Host of the URL
+        host = urlsplit(url).netloc
+        with self.lock:
+            # Get the time the host's circuit opened
+            opened = self.hosts.get(host, (0, None))[1]
+        # If the circuit is closed
+        if opened is None:
+            return 0
+        # Time until a trial request, checking at least every poll (the circuit may close sooner after a trial)
+        return max(0, min(self.circuit_poll, self.circuit_reset - (monotonic() - opened)))
+
+    # Record a failure of a host (a host failure code, a timeout or a connection error)
+    def record_failure(self, url):
+        # Host of the URL
+        host = urlsplit(url).netloc
+        with self.lock:
+            # Get the host's failures and the time its circuit opened
+            failures, opened = self.hosts.get(host, (0, None))
+            failures += 1
+            # If the failures reach the threshold, and the circuit is closed
+            if failures >= self.circuit_failures and opened is None:
+                # Open the circuit
+                opened = monotonic()
+                # Log a warning
+                logging.warning(f'{failures} consecutive failures for {host}. Opening its circuit for '
+                                f'{self.circuit_reset} seconds.')
+            self.hosts[host] = (failures, opened)
+
+    # Record a success for a host (closing its circuit)
+    def record_success(self, url):
+        # Host of the URL
+        host = urlsplit(url).netloc
+        with self.lock:
+            # If the host had failures
+            if host in self.hosts:
+                # If its circuit was open
+                if self.hosts[host][1] is not None:
+                    # Log the info
+                    logging.info(f'Closing the circuit for {host}.')
+                # Forget them
+                del self.hosts[host]
+
+    # Take a retry from the budget (returns False if the budget is spent)
+    def take_retry(self):
+        with self.lock:
+            # If the retries would go over the budget
+            if self.retries + 1 > self.min_retries + self.budget_ratio * self.requests:
+                # If this is the first time
+                if not self.budget_spent:
+                    # Log a warning
+                    logging.warning(f'Retry budget spent ({self.retries} retries for {self.requests} requests).')
+                    self.budget_spent = True
+                # Return False
+                return False
+            # Take the retry
+            self.retries += 1
+            self.budget_spent = False
+            # Return True
+            return True
+
+
+# Shared retry policy for LAADS requests in the process (the run)
+laads_retry_policy = None
+# Lock for creating the shared retry policy
+laads_retry_policy_lock = threading.Lock()
+
+
+# Get the shared retry policy for LAADS requests in the process
+def get_laads_retry_policy():
+    global laads_retry_policy
+    with laads_retry_policy_lock:
+        # If there is no retry policy yet
+        if laads_retry_policy is None:
+            # Create it
+            laads_retry_policy = RetryPolicy()
+    # Return the retry policy
+    return laads_retry_policy
@@ -20,20 +20,52 @@ def main():
     band_list = [31, 40]
     # List of bands from 1 - 31
     band_list += list(arange(1, 22, 1))
+    # List of datasets
+    datasets = []
     # For band in bands
     for band in band_list:
+        # Get a LAADS data set object (the catalog is retrieved below, with the other bands)
+        datasets.append(c_laads.LAADSDataSet(f'MCD43D{t_misc.zero_pad_number(band, digits=2)}_1',
+                                             archive_set='61',
+                                             product=f'MCD43D{t_misc.zero_pad_number(band, digits=2)}',
+                                             start_date=datetime.date(year=2018, month=6, day=20),
+                                             end_date=datetime.date(year=2022, month=1, day=1) + datetime.timedelta(days=192),
+                                             crawl=False))
+    # Log info
+    logging.info(f"Getting catalogs for bands {band_list}.")
+    # Get the catalogs for all the bands in one concurrent crawl
+    failed = c_laads.get_catalogs(datasets)
+    # If any catalogs could not be retrieved
+    if failed:
+        # Log an error
+        logging.error(f"No catalogs for {[dataset.name for dataset in failed]}. Stopping.")
+        # Stop
+        return
+    # Target years to process
+    target_years = [2019, 2020, 2021]
+    # Plan the downloads the target years need (the earliest year first)
+    plan = t_mcd43gf.plan_downloads(datasets, target_years)
+
+    # Staging output ('links' for the symbolic link trees, 'manifests' for one manifest per target year and band)
+    staging_output = 'links'
+
+    # Stage a target year for every band once its files are downloaded
+    def link_year(year):
+        # If staging manifests
+        if staging_output == 'manifests':
+            # Log info
+            logging.info(f"Files for {year} downloaded. Writing its staging manifests.")
+            # Write the manifests for all the datasets
+            t_mcd43gf.write_staging_manifests(datasets, Path(environ['inputs_dir'], 'manifests'), [year])
+            # Return
+            return
         # Log info
-        logging.info(f"Getting catalog for band {band}.")
-        # Get a LAADS data set object (this will generate the catalog)
-        dataset = c_laads.LAADSDataSet(f'MCD43D{t_misc.zero_pad_number(band, digits=2)}_1',
-                                       archive_set='61',
-                                       product=f'MCD43D{t_misc.zero_pad_number(band, digits=2)}',
-                                       start_date=datetime.date(year=2018, month=6, day=20),
-                                       end_date=datetime.date(year=2022, month=1, day=1) + datetime.timedelta(days=192))
-        # Download dataset full catalog
-        dataset.download_catalog()
-        # Create the symlinks
-        t_mcd43gf.create_symbolic_links(dataset, Path(environ['inputs_dir'], 'links'))
+        logging.info(f"Files for {year} downloaded. Creating its symlinks.")
+        # Relink the year for all the datasets (only that year's directories are scanned and changed)
+        t_mcd43gf.relink_symbolic_links(datasets, Path(environ['inputs_dir'], 'links'), [year])
+
+    # Download the planned files, staging each target year as it completes
+    t_mcd43gf.download_plan(plan, on_year_complete=link_year)
 
 
 if __name__ == "__main__":
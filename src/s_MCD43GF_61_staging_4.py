@@ -20,16 +20,29 @@ def main():
     band_list = [31, 40]
     # List of bands from 1 - 31
     band_list += list(arange(1, 22, 1))
+    # List of datasets
+    datasets = []
     # For band in bands
     for band in band_list:
-        # Log info
-        logging.info(f"Getting catalog for band {band}.")
-        # Get a LAADS data set object (this will generate the catalog)
-        dataset = c_laads.LAADSDataSet(f'MCD43D{t_misc.zero_pad_number(band, digits=2)}_4',
-                                       archive_set='61',
-                                       product=f'MCD43D{t_misc.zero_pad_number(band, digits=2)}',
-                                       start_date=datetime.date(year=2012, month=6, day=20),
-                                       end_date=datetime.date(year=2014, month=6, day=19))
+        # Get a LAADS data set object (the catalog is retrieved below, with the other bands)
+        datasets.append(c_laads.LAADSDataSet(f'MCD43D{t_misc.zero_pad_number(band, digits=2)}_4',
+                                             archive_set='61',
+                                             product=f'MCD43D{t_misc.zero_pad_number(band, digits=2)}',
+                                             start_date=datetime.date(year=2012, month=6, day=20),
+                                             end_date=datetime.date(year=2014, month=6, day=19),
+                                             crawl=False))
+    # Log info
+    logging.info(f"Getting catalogs for bands {band_list}.")
+    # Get the catalogs for all the bands in one concurrent crawl
+    failed = c_laads.get_catalogs(datasets)
+    # If any catalogs could not be retrieved
+    if failed:
+        # Log an error
+        logging.error(f"No catalogs for {[dataset.name for dataset in failed]}. Stopping.")
+        # Stop
+        return
+    # For each dataset
+    for dataset in datasets:
         # Download dataset full catalog
         dataset.download_catalog()
 
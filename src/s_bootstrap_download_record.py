@@ -3,10 +3,8 @@ import t_spinup
 import c_laads
 import t_misc
 import logging
-import hashlib
-from os import environ, walk, remove
+from os import environ
 from numpy import arange
-from pathlib import Path
 
 
 # Main function
@@ -28,37 +26,16 @@ def main():
         dataset = c_laads.LAADSDataSet(f'MCD43D{t_misc.zero_pad_number(band, digits=2)}',
                                        archive_set='61',
                                        product=f'MCD43D{t_misc.zero_pad_number(band, digits=2)}')
-        # Get datetime string
-        now_str = datetime.datetime.now().strftime("%m%d%Y_%H%M%S")
-
-        # Open a download log in write mode
-        of = open(Path(environ['support_dir'],
-                       f'{dataset.name}_download_{now_str}.txt'),
-                  mode='w')
-
-        # Walk the download directory
-        for root, dirs, files in walk(Path(environ["inputs_dir"], dataset.name)):
-
-            # For each file name
-            for name in files:
-                # If the name is not in the catalog
-                if name not in dataset.by_filename.keys():
-                    # Delete the file
-                    remove(Path(environ["inputs_dir"], dataset.name, name))
-                # Otherwise (file is in catalog)
-                else:
-                    file_hash = hashlib.md5(
-                        open(Path(environ["inputs_dir"], dataset.name, name), 'rb').read()).hexdigest()
-                    # If the hash matches the reference
-                    if file_hash == dataset.by_filename[name].hash:
-                        # Write a line to the download log
-                        of.write(f'{name} True\n')
-                    # Otherwise (hash does not match)
-                    else:
-                        # Delete the file
-                        remove(Path(environ["inputs_dir"], dataset.name, name))
-        # Close the download record file
-        of.close()
+        # Verify the files already downloaded (hashed across a process pool, skipping files unchanged since they were
+        # last verified), removing any that are not in the catalog or do not match their hash
+        results = dataset.verify_downloads()
+        # Get the download record
+        download_record = dataset.get_download_record()
+        # Keep the files whose status changed (newly verified, or recorded as downloaded but failed verification), so a
+        # rerun does not journal the same files again
+        results = [(name, status) for name, status in results if download_record.get(name, False) != status]
+        # Record the results in the store
+        dataset.store.add_downloads(dataset.name, results)
 
 
 if __name__ == "__main__":
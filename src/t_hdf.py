@@ -0,0 +1,236 @@
+import logging
+import struct
+import h5py
+from io import BytesIO
+from os import fstat
+
+
+# Magic number at the start of an HDF4 file
+HDF4_MAGIC = b'\x0e\x03\x13\x01'
+# Signature of an HDF5 superblock (at byte 0, or 512, 1024, 2048... after a user block)
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+# HDF4 data descriptor tags: empty descriptor, scientific data, numeric data group (a scientific dataset)
+HDF4_TAG_NULL = 1
+HDF4_TAG_SD = 702
+HDF4_TAG_NDG = 720
+# Most HDF4 data descriptor blocks to walk (guards against loops in a corrupt file)
+HDF4_MAX_DD_BLOCKS = 100000
+
+
+# Get the size of an open file object
+def get_file_size(f):
+    # If it is in memory
+    if isinstance(f, BytesIO):
+        return len(f.getbuffer())
+    # Otherwise (file in storage)
+    return fstat(f.fileno()).st_size
+
+
+# Get the format of an open file object from its signature ('hdf4', 'hdf5'), or None
+def get_hdf_format(f):
+    # Read the start of the file
+    f.seek(0)
+    start = f.read(8)
+    # If it has the HDF4 magic number
+    if start[:4] == HDF4_MAGIC:
+        return 'hdf4'
+    # If it has the HDF5 signature
+    if start == HDF5_SIGNATURE:
+        return 'hdf5'
+    # If the HDF5 superblock is after a user block
+    if find_hdf5_superblock(f) is not None:
+        return 'hdf5'
+    # Otherwise (not HDF)
+    return None
+
+
+# Find the offset of the HDF5 superblock in an open file object (or None if there is none)
+def find_hdf5_superblock(f):
+    # Size of the file
+    file_size = get_file_size(f)
+    # Offset to check
+    offset = 0
+    # While the offset is within the file
+    while offset + len(HDF5_SIGNATURE) <= file_size:
+        # Read at the offset
+        f.seek(offset)
+        # If it is the signature
+        if f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+            return offset
+        # Next offset (0, 512, 1024, 2048...)
+        offset = 512 if offset == 0 else offset * 2
+    # Return None
+    return None
+
+
+# Get the size declared by an HDF5 superblock (its end of file address, which includes any user block), or None if
+# not parsable
+def get_hdf5_declared_size(f):
+    # Find the superblock
+    offset = find_hdf5_superblock(f)
+    # If there is none
+    if offset is None:
+        return None
+    # Read the superblock (enough for any version with 8-byte addresses)
+    f.seek(offset)
+    superblock = f.read(128)
+    # Try to parse it
+    try:
+        # Superblock version
+        version = superblock[8]
+        # If version 0 or 1
+        if version in (0, 1):
+            # Size of addresses, and where the addresses start (after the indexed storage K in version 1)
+            address_size = superblock[13]
+            address_start = 24 if version == 0 else 28
+            # Addresses: base, free space info, end of file
+            eof_index = 2
+        # If version 2 or 3
+        elif version in (2, 3):
+            # Size of addresses, and where the addresses start
+            address_size = superblock[9]
+            address_start = 12
+            # Addresses: base, superblock extension, end of file
+            eof_index = 2
+        # Otherwise (unknown version)
+        else:
+            return None
+        # Format for an address of this size (little-endian)
+        address_format = {2: '<H', 4: '<I', 8: '<Q'}[address_size]
+        # End of file address
+        eof = struct.unpack_from(address_format, superblock, address_start + eof_index * address_size)[0]
+    # If it is not parsable
+    except (IndexError, KeyError, struct.error):
+        return None
+    # Return the declared size
+    return eof
+
+
+# Get the data descriptors of an HDF4 file as a list of (tag, ref, offset, length) tuples, or None if not parsable
+def get_hdf4_descriptors(f):
+    # Size of the file
+    file_size = get_file_size(f)
+    # List of descriptors
+    descriptors = []
+    # Offset of the first data descriptor block (after the magic number)
+    block_offset = 4
+    # Blocks walked
+    blocks = 0
+    # While there is a block
+    while block_offset:
+        # Count the block
+        blocks += 1
+        # If the block is outside the file, or there are too many blocks
+        if block_offset + 6 > file_size or blocks > HDF4_MAX_DD_BLOCKS:
+            return None
+        # Read the block header (number of descriptors, offset of the next block)
+        f.seek(block_offset)
+        n_descriptors, next_offset = struct.unpack('>HI', f.read(6))
+        # Read the descriptors
+        data = f.read(n_descriptors * 12)
+        # If the block is cut off
+        if len(data) < n_descriptors * 12:
+            return None
+        # Add the descriptors (big-endian tag, ref, offset, length)
+        descriptors.extend(struct.iter_unpack('>HHII', data))
+        # Move to the next block
+        block_offset = next_offset
+    # Return the descriptors
+    return descriptors
+
+
+# Get the size declared by the data descriptors of an HDF4 file (the end of its furthest element), or None
+def get_hdf4_declared_size(f):
+    # Get the descriptors
+    descriptors = get_hdf4_descriptors(f)
+    # If they are not parsable
+    if descriptors is None:
+        return None
+    # Return the end of the furthest element (ignoring empty descriptors)
+    return max([offset + length for tag, ref, offset, length in descriptors
+                if tag != HDF4_TAG_NULL and offset != 0xFFFFFFFF and length != 0xFFFFFFFF], default=4)
+
+
+# Check the signature and declared size of an open HDF file object (fast tier: a few small reads).
+# Returns the format ('hdf4', 'hdf5'), or None if it is not a whole HDF file.
+def check_hdf_signature(f):
+    # Get the format
+    hdf_format = get_hdf_format(f)
+    # If it is not HDF
+    if not hdf_format:
+        logging.debug('File does not have an HDF4 or HDF5 signature.')
+        return None
+    # Get the declared size
+    if hdf_format == 'hdf4':
+        declared_size = get_hdf4_declared_size(f)
+    else:
+        declared_size = get_hdf5_declared_size(f)
+    # If the declared size is not parsable, or the file is shorter (e.g. truncated)
+    if declared_size is None or get_file_size(f) < declared_size:
+        logging.debug(f'File is shorter than its declared size ({declared_size}).')
+        return None
+    # Return the format
+    return hdf_format
+
+
+# Validate a file in storage by its HDF signature and declared size (returns the path, or None)
+def validate_file_signature(file_path):
+    # Open the file
+    with open(file_path, 'rb') as f:
+        # If the signature check fails
+        if not check_hdf_signature(f):
+            # Log the occurrence
+            logging.debug(f'{file_path} failed the HDF signature check.')
+            # Return None
+            return None
+    # Return the path
+    return file_path
+
+
+# Validate a request's contents by their HDF signature and declared size (returns the response, or None)
+def validate_request_signature(r):
+    # If the signature check fails
+    if not check_hdf_signature(BytesIO(r.content)):
+        # Log the occurrence
+        logging.debug('Response content failed the HDF signature check.')
+        # Return None
+        return None
+    # Return the response
+    return r
+
+
+# Validate a file in storage by opening it and listing its datasets (deep tier, for a process pool).
+# Returns the path, or None.
+def validate_file_deep(file_path):
+    # Try to open and list the file
+    try:
+        with open(file_path, 'rb') as f:
+            # Check the signature and declared size
+            hdf_format = check_hdf_signature(f)
+            # If this is HDF4
+            if hdf_format == 'hdf4':
+                # Scientific datasets, and the elements of the file
+                descriptors = get_hdf4_descriptors(f)
+                datasets = [ref for tag, ref, offset, length in descriptors if tag in (HDF4_TAG_SD, HDF4_TAG_NDG)]
+        # If this is HDF5
+        if hdf_format == 'hdf5':
+            # List of datasets
+            datasets = []
+            with h5py.File(file_path, 'r') as h5:
+                # Visit every object, listing the datasets (reads their headers)
+                h5.visititems(lambda name, item: datasets.append((name, item.shape))
+                              if isinstance(item, h5py.Dataset) else None)
+    # If not successful
+    except (OSError, RuntimeError, struct.error) as e:
+        # Log the occurrence
+        logging.debug(f'{file_path} could not be listed: {e!r}.')
+        # Return None
+        return None
+    # If it is not HDF, or has no datasets
+    if not hdf_format or not datasets:
+        # Log the occurrence
+        logging.debug(f'{file_path} has no datasets.')
+        # Return None
+        return None
+    # Return the path
+    return file_path
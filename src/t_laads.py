@@ -1,36 +1,111 @@
 import requests
+import threading
 import logging
 import t_spinup
 import t_requests
 import t_misc
-from os import environ
+import t_hdf
+import c_laads_cache
+import c_rate_limiter
+import c_retry_policy
+import datetime
+import re
+from collections import namedtuple
+from os import environ, getpid
+
+
+# Default connection pool size for a session shared between threads (requests' own default)
+SESSION_POOL_MAXSIZE = 10
+# Connection pool size for a session used by a single thread (see get_thread_laads_session)
+THREAD_SESSION_POOL_MAXSIZE = 2
+
+# Sessions for each thread (one keep-alive session per worker)
+thread_sessions = threading.local()
 
 
 # Get a request session object from LAADS via token-based authorization
-def get_laads_session():
+# (pool_maxsize should match the number of threads that will share the session)
+def get_laads_session(pool_maxsize=SESSION_POOL_MAXSIZE):
     # Header command utilizing security token
     auth_token = {'Authorization': f'Bearer {environ["laads_token"]}'}
     # Create session
     s = requests.session()
     # Update header with authorization
     s.headers.update(auth_token)
+    # Adapter with a connection pool sized for the threads sharing the session
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
     # Return the session object
     return s
 
 
-# Get a json from LAADS
-def get_laads_json(json_url, session=get_laads_session()):
+# Get the LAADS session for the current thread (created on first use, and again in a forked process)
+def get_thread_laads_session():
+    # If the thread has no session, or it was inherited from a parent process
+    if getattr(thread_sessions, 'pid', None) != getpid():
+        # Create the thread's session
+        thread_sessions.session = get_laads_session(pool_maxsize=THREAD_SESSION_POOL_MAXSIZE)
+        thread_sessions.pid = getpid()
+    # Return the session
+    return thread_sessions.session
+
+
+# Replace the LAADS session for the current thread with a new one (session_func for t_requests.ask_nicely)
+def refresh_thread_laads_session():
+    # If the thread has a session of its own
+    if getattr(thread_sessions, 'pid', None) == getpid():
+        # Close it (dropping its connections)
+        thread_sessions.session.close()
+        # Forget it
+        del thread_sessions.pid
+    # Log the info
+    logging.info(f'Refreshing LAADS session for thread {threading.get_ident()}.')
+    # Return a new session for the thread
+    return get_thread_laads_session()
+
+
+# Get a json from LAADS (through the directory listing cache, unless use_cache is False), optionally under a
+# concurrency limiter (see c_aimd_limiter)
+def get_laads_json(json_url, session=None, use_cache=True, limiter=None):
+    # If no session was provided
+    if not session:
+        # Use the thread's session
+        session = get_thread_laads_session()
     # Ensure the json_url ends in .json
     if json_url.split('.')[-1] != 'json':
         json_url += '.json'
-    # Ask nicely for the json, validating with a conversion to json
-    r = t_requests.ask_nicely(session, json_url, validation_func=t_requests.validate_request_json)
+    # If using the cache
+    if use_cache:
+        # Get the json through the cache (conditional request, if it has expired), validating as json
+        r = c_laads_cache.get_json_cache().get_json(session,
+                                                    json_url,
+                                                    t_requests.ask_nicely,
+                                                    session_func=refresh_thread_laads_session,
+                                                    rate_limiter=c_rate_limiter.get_laads_rate_limiter(),
+                                                    retry_policy=c_retry_policy.get_laads_retry_policy(),
+                                                    limiter=limiter,
+                                                    validation_func=t_requests.validate_request_json_response)
+    # Otherwise
+    else:
+        # Ask nicely for the json, validating with a conversion to json
+        r = t_requests.ask_nicely(session,
+                                  json_url,
+                                  session_func=refresh_thread_laads_session,
+                                  rate_limiter=c_rate_limiter.get_laads_rate_limiter(),
+                                  retry_policy=c_retry_policy.get_laads_retry_policy(),
+                                  limiter=limiter,
+                                  validation_func=t_requests.validate_request_json)
     # Return the parse of the get attempt
     return parse_laads_get(r, json_url)
 
 
 # Get a HDF5 file from LAADS
-def get_laads_hdf5(h5_request, session=get_laads_session(), hash_to_check=None):
+def get_laads_hdf5(h5_request, session=None, hash_to_check=None):
+    # If no session was provided
+    if not session:
+        # Use the thread's session
+        session = get_thread_laads_session()
     # If a tuple of h5 url and a hash was supplied
     if isinstance(h5_request, tuple):
         # Break up the components
@@ -50,15 +125,22 @@ def get_laads_hdf5(h5_request, session=get_laads_session(), hash_to_check=None):
     # Ask nicely for the HDF5 file, checking the hash
     r = t_requests.ask_nicely(session,
                               h5_url,
+                              session_func=refresh_thread_laads_session,
+                              rate_limiter=c_rate_limiter.get_laads_rate_limiter(),
+                              retry_policy=c_retry_policy.get_laads_retry_policy(),
                               hash_func=hash_func,
                               hash_to_check=hash_to_check,
-                              validation_func=t_requests.validate_request_hdf5)
+                              validation_func=t_hdf.validate_request_signature)
     # Return a tuple of the URL and a parse of the get attempt
     return (h5_url, parse_laads_get(r, h5_url))
 
 
 # Get a HDF4 file from LAADS
-def get_laads_hdf4(h4_request, session=get_laads_session(), hash_to_check=None):
+def get_laads_hdf4(h4_request, session=None, hash_to_check=None):
+    # If no session was provided
+    if not session:
+        # Use the thread's session
+        session = get_thread_laads_session()
     # If a tuple of h5 url and a hash was supplied
     if isinstance(h4_request, tuple):
         # Break up the components
@@ -78,12 +160,52 @@ def get_laads_hdf4(h4_request, session=get_laads_session(), hash_to_check=None):
     # Ask nicely for the HDF5 file, checking the hash
     r = t_requests.ask_nicely(session,
                               h4_url,
+                              session_func=refresh_thread_laads_session,
+                              rate_limiter=c_rate_limiter.get_laads_rate_limiter(),
+                              retry_policy=c_retry_policy.get_laads_retry_policy(),
                               hash_func=hash_func,
-                              hash_to_check=hash_to_check)
+                              hash_to_check=hash_to_check,
+                              validation_func=t_hdf.validate_request_signature)
     # Return a tuple of the URL and a parse of the get attempt
     return (h4_url, parse_laads_get(r, h4_url))
 
 
+# Download a file from LAADS straight to storage (streamed in chunks, hashed as it arrives, atomically renamed,
+# and resumed with a Range request from any partial file left by an interrupted attempt or run)
+# from a tuple of (URL, hash, write path), optionally under a concurrency limiter (see c_aimd_limiter).
+# Returns a tuple of the URL and whether the file was downloaded.
+def download_laads_file(download_request, session=None, limiter=None):
+    # If no session was provided
+    if not session:
+        # Use the thread's session
+        session = get_thread_laads_session()
+    # Break up the components
+    url, hash_to_check, write_path = download_request
+    # File validation function (a quick check of the HDF signature and declared size, so the download thread is not
+    # held up parsing the file; see t_hdf.validate_file_deep for a full check)
+    file_validation_func = None
+    # If this is a HDF4 or HDF5 file
+    if url.split('.')[-1] in ('hdf', 'h5'):
+        # Check its signature in storage
+        file_validation_func = t_hdf.validate_file_signature
+    # Ask nicely for the file, streaming it to storage (resuming any partial file left by an earlier attempt or run)
+    r = t_requests.ask_nicely(session,
+                              url,
+                              session_func=refresh_thread_laads_session,
+                              rate_limiter=c_rate_limiter.get_laads_rate_limiter(),
+                              retry_policy=c_retry_policy.get_laads_retry_policy(),
+                              limiter=limiter,
+                              stream=True,
+                              headers_func=lambda: t_requests.get_resume_headers(write_path, hash_to_check),
+                              ok_codes=(200, 206, 416),
+                              validation_func=t_requests.get_stream_to_file_func(
+                                  write_path,
+                                  hash_to_check=hash_to_check,
+                                  file_validation_func=file_validation_func))
+    # Return a tuple of the URL and whether it was successful
+    return (url, parse_laads_get(r, url) is not None)
+
+
 # Parse the result of getting a file from LAADS
 def parse_laads_get(r, url):
     # If we got a response
@@ -112,6 +234,75 @@ def get_date_from_filename(filename):
     return t_misc.get_dateobj_from_yeardoy(year, doy)
 
 
+# Fields of a LAADS format filename (e.g. VNP46A2.A2019152.h11v07.001.2019160000000.h5)
+LAADSFilename = namedtuple('LAADSFilename',
+                           ['product', 'date', 'year', 'doy', 'tile', 'collection', 'production', 'suffix'])
+
+
+# Parse a LAADS format filename into its fields (tile, collection and production are None if absent), or None if it
+# is not a LAADS format filename
+def parse_filename(filename):
+    # Split the file name once
+    split_name = filename.split('.')
+    # Try to get the product, and year and DOY from the AYYYYDDD date string
+    try:
+        product = split_name[0]
+        year = int(split_name[1][1:5])
+        doy = int(split_name[1][5:8])
+        date = t_misc.get_dateobj_from_yeardoy(year, doy)
+    # If there is no date string
+    except (IndexError, ValueError):
+        # Log the occurrence
+        logging.debug(f'{filename} is not a LAADS format file name.')
+        # Return None
+        return None
+    # Remaining parts (tile, collection, production timestamp, suffix)
+    parts = split_name[2:]
+    # Suffix
+    suffix = parts.pop() if parts else None
+    # Production timestamp (YYYYDDDHHMMSS)
+    production = None
+    if parts and len(parts[-1]) == 13 and parts[-1].isdigit():
+        # Try to parse it (otherwise it is not a timestamp)
+        try:
+            production = datetime.datetime.strptime(parts[-1], '%Y%j%H%M%S')
+            parts.pop()
+        except ValueError:
+            pass
+    # Tile (hHHvVV)
+    tile = None
+    if parts and re.fullmatch(r'h\d{2}v\d{2}', parts[0]):
+        tile = parts.pop(0)
+    # Collection
+    collection = parts[-1] if parts else None
+    # Return the fields
+    return LAADSFilename(product,
+                         date,
+                         year,
+                         doy,
+                         tile,
+                         collection,
+                         production,
+                         suffix)
+
+
+# Get the granule key from a LAADS format filename (the file name without its production timestamp, so that
+# reprocessed versions of a granule share a key)
+def get_granule_key_from_filename(filename):
+    # Parse the file name
+    fields = parse_filename(filename)
+    # If it has no production timestamp
+    if fields is None or fields.production is None:
+        # The key is the file name
+        return filename
+    # Split the file name
+    split_name = filename.split('.')
+    # Remove the production timestamp (the part before the suffix)
+    del split_name[-2]
+    # Return the key
+    return '.'.join(split_name)
+
+
 # Get year and DOY from filename
 def get_year_doy_from_filename(filename):
     # Split out the date string
@@ -0,0 +1,276 @@
+import asyncio
+import aiohttp
+import json
+import logging
+import c_laads_cache
+import c_rate_limiter
+import c_retry_policy
+from os import environ
+from functools import partial
+
+
+# Default limit on concurrent connections for the asynchronous engine
+MAX_CONNECTIONS = 200
+
+
+# Get an asynchronous (aiohttp) session object for LAADS via token-based authorization
+def get_laads_async_session(max_connections=MAX_CONNECTIONS):
+    # Connection pool with keep-alive, so connections are reused between requests
+    connector = aiohttp.TCPConnector(limit=max_connections,
+                                     limit_per_host=max_connections,
+                                     keepalive_timeout=60)
+    # Create session with the authorization header
+    return aiohttp.ClientSession(connector=connector,
+                                 headers={'Authorization': f'Bearer {environ["laads_token"]}'},
+                                 timeout=aiohttp.ClientTimeout(total=300))
+
+
+# Wait while the circuit for a URL's host is open in a retry policy (up to its max_circuit_wait), without blocking
+# other requests. Returns True once a request is allowed, or False if the wait ran out.
+async def wait_for_circuit(retry_policy, url):
+    # Seconds waited
+    waited = 0
+    # While the circuit does not allow the request
+    while not retry_policy.allow_request(url):
+        # If the wait ran out
+        if waited >= retry_policy.max_circuit_wait:
+            return False
+        # Wait before checking again (at least a moment, in case another request took the trial)
+        wait = max(0.1, retry_policy.get_circuit_wait(url))
+        await asyncio.sleep(wait)
+        waited += wait
+    # Return True
+    return True
+
+
+# Ask nicely (asynchronously) for a json, backing off without blocking other requests.
+# Returns a tuple of (status code, response headers, content, json), or None if unsuccessful.
+async def ask_nicely_json(session,
+                          semaphore,
+                          url,
+                          headers=None,
+                          ok_codes=(200,),
+                          rate_limiter=None,
+                          retry_policy=None,
+                          back_off_base=0,
+                          back_off_inc=1,
+                          max_attempts=10):
+    # Reference the event loop (the rate limiter's file locks are taken on its default executor, not the loop)
+    loop = asyncio.get_event_loop()
+    # Seconds the server asked us to wait before retrying (Retry-After), if any
+    retry_after = None
+    # For each attempt
+    for attempt in range(1, max_attempts + 1):
+        # If this is not the first attempt
+        if attempt > 1:
+            # If there is a retry policy
+            if retry_policy:
+                # If the retry budget for the run is spent
+                if not retry_policy.take_retry():
+                    # Log the info
+                    logging.info(f'Request for {url} not retried (retry budget spent).')
+                    # Stop
+                    break
+                # Wait for the policy's delay (exponential with full jitter, or the server's Retry-After)
+                await asyncio.sleep(retry_policy.get_delay(attempt - 1, retry_after))
+                retry_after = None
+            # Otherwise
+            else:
+                # Add to the back-off timer
+                back_off_base += back_off_inc
+                # Wait quietly and politely (other requests carry on)
+                await asyncio.sleep(back_off_base)
+        # If there is a retry policy, and the host's circuit stayed open for too long
+        if retry_policy and not await wait_for_circuit(retry_policy, url):
+            # Log the info
+            logging.info(f'Request for {url} not made (circuit open for the host).')
+            # Stop
+            break
+        # If there is a rate limiter (shared by every process on the host)
+        if rate_limiter:
+            # Wait for a turn (without blocking other requests)
+            await asyncio.sleep(await loop.run_in_executor(None, rate_limiter.reserve))
+        # Hold a slot in the semaphore only while requesting
+        async with semaphore:
+            # Try to make the request
+            try:
+                async with session.get(url, allow_redirects=False, headers=headers) as r:
+                    # If the request does not have a success code (code 200, or others accepted e.g. 304)
+                    if r.status not in ok_codes:
+                        # Log a non-200 status code
+                        logging.info(f'Request for {url}, attempt {attempt} returned code: {r.status}.')
+                        # If there is a retry policy
+                        if retry_policy:
+                            # If the host failed
+                            if r.status in c_retry_policy.HOST_FAILURE_CODES:
+                                # Record the failure
+                                retry_policy.record_failure(url)
+                            # If the code will not change on a retry
+                            if not retry_policy.should_retry(r.status):
+                                # Log the info
+                                logging.info(f'Request for {url} not retried (code {r.status}).')
+                                # Stop
+                                break
+                            # Get any Retry-After from the server
+                            retry_after = retry_policy.get_retry_after(r.status, r.headers)
+                        # Move to next attempt
+                        continue
+                    # If there is a retry policy
+                    if retry_policy:
+                        # Record the success of the host
+                        retry_policy.record_success(url)
+                    # If the request was accepted without content (e.g. 304 Not Modified)
+                    if r.status != 200:
+                        # Return the response details
+                        return r.status, r.headers, None, None
+                    # Read the content
+                    content = await r.read()
+                    # If there is a rate limiter
+                    if rate_limiter:
+                        # Take the bytes received
+                        await loop.run_in_executor(None, rate_limiter.consume_bytes, len(content))
+                    # Try to parse the response into json
+                    try:
+                        return r.status, r.headers, content, json.loads(content)
+                    # If not successful
+                    except ValueError:
+                        # Log the occurrence
+                        logging.info(f'Request for {url}, attempt {attempt} was not a valid JSON.')
+                        # Move to next attempt
+                        continue
+            # If the request failed outright
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Log the error
+                logging.info(f'Request for {url}, attempt {attempt} raised {e!r}.')
+                # If there is a retry policy
+                if retry_policy:
+                    # Record the failure of the host
+                    retry_policy.record_failure(url)
+    # Log the failure
+    logging.error(f'Request for {url} failed after {attempt} attempts.')
+    # Return None
+    return None
+
+
+# Get a json from LAADS (asynchronously, through the directory listing cache unless use_cache is False). The cache's
+# SQLite calls run on the event loop's default executor (the cache has a connection per thread), so they do not stall
+# the other requests.
+async def get_laads_json(session, semaphore, json_url, use_cache=True):
+    # Ensure the json_url ends in .json
+    if json_url.split('.')[-1] != 'json':
+        json_url += '.json'
+    # If not using the cache
+    if not use_cache:
+        # Ask nicely for the json
+        r = await ask_nicely_json(session,
+                                  semaphore,
+                                  json_url,
+                                  rate_limiter=c_rate_limiter.get_laads_rate_limiter(),
+                                  retry_policy=c_retry_policy.get_laads_retry_policy())
+        # If unsuccessful
+        if r is None:
+            # Log the error
+            logging.error(f'Attempt to get {json_url} failed.')
+            # Return None
+            return None
+        # Return the json
+        return r[3]
+    # Reference the event loop and the cache
+    loop = asyncio.get_event_loop()
+    cache = c_laads_cache.get_json_cache()
+    # If there is a fresh listing
+    listing = await loop.run_in_executor(None, cache.get_fresh, json_url)
+    if listing is not None:
+        # Return it without a request
+        return listing
+    # Ask nicely with a conditional request
+    r = await ask_nicely_json(session,
+                              semaphore,
+                              json_url,
+                              headers=await loop.run_in_executor(None, cache.get_conditional_headers, json_url),
+                              ok_codes=(200, 304),
+                              rate_limiter=c_rate_limiter.get_laads_rate_limiter(),
+                              retry_policy=c_retry_policy.get_laads_retry_policy())
+    # If unsuccessful
+    if r is None:
+        # Get any stale listing
+        listing = await loop.run_in_executor(None, partial(cache.get_cached, json_url, revalidated=False))
+        # If there was one
+        if listing is not None:
+            # Log a warning
+            logging.warning(f'Using stale cached listing for {json_url}.')
+        # Otherwise
+        else:
+            # Log the error
+            logging.error(f'Attempt to get {json_url} failed.')
+        # Return the stale listing (or None)
+        return listing
+    # If the listing was not modified
+    if r[0] == 304:
+        # Return the cached listing
+        return await loop.run_in_executor(None, cache.get_cached, json_url)
+    # Store the listing
+    await loop.run_in_executor(None, cache.put, json_url, r[2], r[1])
+    # Return the json
+    return r[3]
+
+
+# Get a semaphore for each level of a crawl (from within the event loop)
+def get_level_semaphores(level_workers):
+    return {level: asyncio.Semaphore(workers) for level, workers in level_workers.items()}
+
+
+# Crawl levels of LAADS listings as a pipeline (see t_misc.multithread_pipeline), on an existing session
+# and level semaphores (which can be shared by several crawls). Returns the numbers of (listings, failed listings).
+async def crawl_pipeline(session, semaphores, initial_work, expand_func):
+    # Set of running tasks
+    tasks = set()
+    # Counters for the listings, and those that failed
+    counts = [0, 0]
+
+    # Get a listing and queue any work it feeds
+    async def visit(level, url):
+        # Get the listing
+        listing = await get_laads_json(session, semaphores[level], url)
+        # Count the listing
+        counts[0] += 1
+        # If it failed
+        if not listing:
+            counts[1] += 1
+        # For each new piece of work
+        for new_level, new_url in expand_func(level, url, listing):
+            # Start it
+            tasks.add(asyncio.ensure_future(visit(new_level, new_url)))
+
+    # Start the initial work
+    for level, url in initial_work:
+        tasks.add(asyncio.ensure_future(visit(level, url)))
+    # While tasks are running
+    while tasks:
+        # Wait for at least one to finish
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        # For each finished task
+        for task in done:
+            # Remove it
+            tasks.discard(task)
+            # Raise any unexpected error
+            task.result()
+    # Return the counts
+    return tuple(counts)
+
+
+# Run a coroutine function taking a session and level semaphores (e.g. a crawl), from synchronous code
+def run_with_session(coroutine_func, level_workers, max_connections=MAX_CONNECTIONS):
+
+    # If the levels allow more concurrent requests than there are connections
+    if sum(level_workers.values()) > max_connections:
+        # Log a warning (the extra requests wait for a connection while their timeouts run)
+        logging.warning(f'Level workers {level_workers} add up to more than the {max_connections} connections.')
+
+    # Run the coroutine in its own session
+    async def run():
+        async with get_laads_async_session(max_connections=max_connections) as session:
+            return await coroutine_func(session, get_level_semaphores(level_workers))
+
+    # Run the event loop until the coroutine is finished
+    return asyncio.run(run())
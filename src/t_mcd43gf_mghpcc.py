@@ -1,27 +1,578 @@
 import t_spinup
 import t_misc
 import t_laads
+import c_link_plan
+import c_aimd_limiter
 import datetime
 import logging
-from os import environ, mkdir, symlink
+import hashlib
+import json
+from os import mkdir, makedirs, symlink, readlink, replace, remove, scandir
 from os.path import exists
 from pathlib import Path
+import numpy as np
 from numpy import arange
+from time import time
+from functools import partial
 
 
-# Takes a LAADSDataSet object and a destination directory
-def create_symbolic_links(dataset, dest_dir):
+# Default concurrent workers for linking (partitions of target year and band)
+LINK_WORKERS = 16
+# Default concurrent workers for downloading a plan
+DOWNLOAD_WORKERS = 5
+# Days after January 1 of the year after a target year that its processing window ends
+TARGET_WINDOW_END_DAYS = 192
+
+
+# Get the processing window of a target year as (start date, end date): June 20 of the year before to 192 days after
+# January 1 of the year after
+def get_target_window(year):
+    return (datetime.date(year=year - 1, month=6, day=20),
+            datetime.date(year=year + 1, month=1, day=1) + datetime.timedelta(days=TARGET_WINDOW_END_DAYS))
+
+
+# Get the target band directories (2-digit zero-padded bands) for a data product
+def get_target_bands(product):
+    # If the data product name is MCD43D31 or MCD43D40 (which are used by every band)
+    if product == "MCD43D31" or product == "MCD43D40":
+        # The target bands will be all bands
+        return ['01', '02', '03', '04', '05', '06', '07']
+    # Otherwise, get the band directory name
+    return [t_misc.zero_pad_number(round((int(product[-2:]) + 1) / 3), digits=2)]
+
+
+# Plan the downloads needed to process target years with a list of LAADSDataSet objects (optionally only for some
+# target bands, e.g. ['01', '02']). Returns a list of (target year, dataset, list of (file name, hash) tuples), in
+# order of the target years, so that every file a target year needs is planned with it or an earlier year. Files that
+# are already downloaded, or planned for an earlier year, are skipped.
+def plan_downloads(datasets, target_years, bands=None):
+    # List of planned downloads
+    plan = []
+    # Dictionary of dataset names to the sets of file names downloaded or planned so far
+    planned = {}
+    # For each dataset
+    for dataset in datasets:
+        # If there is no catalog
+        if dataset.catalog is None:
+            # Log an error
+            logging.error(f'No catalog for LAADSDataSet {dataset.name}. It will not be planned.')
+            continue
+        # Start with the files already downloaded
+        planned[dataset.name] = {filename for filename, status in dataset.get_download_record().items() if status}
+    # For each target year (the earliest first)
+    for year in sorted(set(target_years)):
+        # Get the processing window
+        start_date, end_date = get_target_window(year)
+        # For each dataset with a catalog
+        for dataset in [dataset for dataset in datasets if dataset.name in planned]:
+            # If only some bands are needed, and the dataset is not used by any of them
+            if bands and not set(get_target_bands(dataset.product)) & set(bands):
+                # Skip it
+                continue
+            # Reference the catalog
+            catalog = dataset.catalog
+            # List of file names and hashes to download
+            to_download = []
+            # For each file in the window
+            for index in range(*catalog.get_date_range_slice(start_date, end_date).indices(len(catalog))):
+                # File name
+                filename = catalog.names[index].decode()
+                # If it is not downloaded or planned already
+                if filename not in planned[dataset.name]:
+                    # Add the file name and hash
+                    to_download.append((filename, catalog.get_hash(index)))
+                    planned[dataset.name].add(filename)
+            # If there is anything to download
+            if to_download:
+                # Add to the plan
+                plan.append((year, dataset, to_download))
+    # Log the info
+    logging.info(f'Planned {sum([len(files) for year, dataset, files in plan])} downloads for target years '
+                 f'{sorted(set(target_years))}.')
+    # Return the plan
+    return plan
+
+
+# Download the files in a plan from plan_downloads in one download queue across its target years and datasets (the
+# earliest year first, and workers take the next file as soon as they finish one, so no year or dataset waits on the
+# slowest file of another). Once a target year and every earlier one have finished (a year can need files planned
+# with an earlier year), on_year_complete is called with the year (e.g. to link it while later years download), unless
+# any file in its window failed, in which case they are logged and the callback is skipped. Results are recorded in
+# each dataset's store every record_every files. With adaptive, downloads run under the shared concurrency limiter
+# (see LAADSDataSet.download_catalog).
+def download_plan(plan, on_year_complete=None, workers=DOWNLOAD_WORKERS, max_in_flight=None, record_every=20,
+                  adaptive=False):
+    # Target years in the plan (in order)
+    years = sorted({year for year, dataset, files in plan})
+    # Dictionary of target years to their files not yet finished
+    remaining = {year: 0 for year in years}
+    for year, dataset, files in plan:
+        remaining[year] += len(files)
+    # List of (target year, file name) tuples of the files that failed
+    failed = []
+    # Dictionary of dataset names to the dataset and its results not yet recorded
+    results = {}
+    # For each dataset in the plan
+    for year, dataset, files in plan:
+        # Add it to the results
+        results.setdefault(dataset.name, (dataset, []))
+        # Make its download directory
+        makedirs(dataset.get_file_path(files[0][0]).parent, exist_ok=True)
+    # Dictionary of work (URL, hash, write path) to its target year and dataset
+    work_info = {}
+
+    # Generate the work for the download queue (the earliest target year first) as the workers need it
+    def get_work():
+        # For each target year and dataset planned
+        for year, dataset, files in sorted(plan, key=lambda item: item[0]):
+            # For each file name and hash
+            for filename, file_hash in files:
+                # Work for the file
+                work = (dataset.get_url_from_filename(filename), file_hash, dataset.get_file_path(filename))
+                work_info[work] = (year, dataset)
+                yield work
+
+    # Record the results not yet recorded for each dataset
+    def record_results():
+        for dataset, dataset_results in results.values():
+            dataset.store.add_downloads(dataset.name, dataset_results)
+            dataset_results.clear()
+
+    # Finish a target year (all its files and those of earlier years are finished)
+    def finish_year(year):
+        # Log the info
+        logging.info(f'Downloads for target year {year} finished.')
+        # Record the results so far (so they are in the store for the callback)
+        record_results()
+        # If there is no callback
+        if not on_year_complete:
+            return
+        # Processing window of the year
+        start_date, end_date = get_target_window(year)
+        # Files of the year, or an earlier year, in its window that failed
+        missing = [filename for failed_year, filename in failed if failed_year <= year and
+                   start_date <= t_laads.get_date_from_filename(filename) <= end_date]
+        # If any are missing
+        if missing:
+            # Log an error
+            logging.error(f'{len(missing)} files for target year {year} did not download. Skipping its callback. '
+                          f'Missing: {", ".join(missing)}')
+            return
+        # Call the callback with the year
+        on_year_complete(year)
+
+    # Download function
+    download_func = t_laads.download_laads_file
+    # If the concurrency should adapt to the server
+    if adaptive:
+        # Reference the shared concurrency limiter
+        limiter = c_aimd_limiter.get_laads_limiter()
+        # Enough workers for the limiter's maximum (the limiter decides how many are downloading)
+        workers = limiter.max_limit
+        # Download under the limiter
+        download_func = partial(t_laads.download_laads_file, limiter=limiter)
+    # Log the info
+    logging.info(f'Sending {sum(remaining.values())} files for target years {years} to {workers} download workers.')
+    # Mark start time
+    stime = time()
+    # Results since they were last recorded
+    unrecorded = 0
+    # For each file as it is completed
+    for work, (url, downloaded) in t_misc.multithread_queue(download_func,
+                                                            get_work(),
+                                                            max_workers=workers,
+                                                            max_in_flight=max_in_flight):
+        # Get its target year and dataset
+        year, dataset = work_info.pop(work)
+        # File name
+        filename = url.split('/')[-1]
+        # Add the result for the dataset
+        results[dataset.name][1].append((filename, downloaded))
+        unrecorded += 1
+        # If it failed
+        if not downloaded:
+            # Add to the failed files
+            failed.append((year, filename))
+        # If there are enough results to record
+        if unrecorded >= record_every:
+            # Record them in the stores
+            record_results()
+            unrecorded = 0
+        # One less file for the year
+        remaining[year] -= 1
+        # While the earliest unfinished year has no files remaining
+        while years and remaining[years[0]] == 0:
+            # Finish it
+            finish_year(years.pop(0))
+    # Record any remaining results
+    record_results()
+    # For each dataset in the plan
+    for dataset, dataset_results in results.values():
+        # Compact the download journal if it has grown too long
+        dataset.store.compact_downloads(dataset.name)
+    # Log the info
+    logging.info(f'Planned downloads finished in {np.around(time() - stime, decimals=2)} seconds '
+                 f'({len(failed)} failed).')
+    # If the concurrency adapted to the server
+    if adaptive:
+        # Report on the limiter
+        logging.info(f'Concurrency limiter after downloads: {limiter.get_stats()}.')
+
+
+# Get the processing windows of target years as arrays of (start, end) date ordinals (in the order of the years)
+def get_target_window_ordinals(target_years):
+    # Windows of the target years
+    windows = [get_target_window(year) for year in target_years]
+    # Return the starts and ends
+    return (np.array([start.toordinal() for start, end in windows], dtype=np.int32),
+            np.array([end.toordinal() for start, end in windows], dtype=np.int32))
+
+
+# Plan the symbolic links for target years from a list of LAADSDataSet objects. The windows of the target years are
+# an interval index (their starts and ends both increase with the year), so the target years of every file are found
+# with two binary searches instead of testing each date against each window. Returns a LinkPlan of compact arrays.
+def plan_symbolic_links(datasets, target_years):
+    # Sorted target years
+    target_years = np.array(sorted(set(target_years)), dtype=np.int16)
+    # Window starts and ends of the target years
+    window_starts, window_ends = get_target_window_ordinals(target_years.tolist())
+    # Lists of the plan's columns for each dataset and band
+    dataset_indices, file_indices, link_years, bands, file_years = [], [], [], [], []
+    # For each dataset
+    for dataset_index, dataset in enumerate(datasets):
+        # If there is no catalog
+        if dataset.catalog is None:
+            # Log an error
+            logging.error(f'No catalog for LAADSDataSet {dataset.name}. Its links will not be planned.')
+            continue
+        # Date ordinals of the files
+        dates = dataset.catalog.dates
+        # First target year whose window ends on or after each date, and the first whose window starts after it
+        first = np.searchsorted(window_ends, dates, side='left')
+        last = np.searchsorted(window_starts, dates, side='right')
+        # Number of target years for each file
+        counts = np.maximum(last - first, 0)
+        # Repeat each file for its target years
+        files = np.repeat(np.arange(len(dates), dtype=np.int32), counts)
+        # Position of each repeat within its file's target years
+        offsets = np.arange(len(files)) - np.repeat(np.cumsum(counts) - counts, counts)
+        # Target year of each repeat
+        years = target_years[np.repeat(first, counts) + offsets]
+        # Years of the files
+        years_of_files = dataset.catalog.get_years_doys_from_ordinals(dates[files])[0]
+        # For each target band of the dataset
+        for band in get_target_bands(dataset.product):
+            # Add the columns
+            dataset_indices.append(np.full(len(files), dataset_index, dtype=np.uint16))
+            file_indices.append(files)
+            link_years.append(years)
+            bands.append(np.full(len(files), int(band), dtype=np.uint8))
+            file_years.append(years_of_files)
+    # If there is nothing to link
+    if not file_indices:
+        # Return an empty plan
+        return c_link_plan.LinkPlan(datasets, [], [], [], [], [])
+    # Return the plan
+    return c_link_plan.LinkPlan(datasets,
+                                np.concatenate(dataset_indices),
+                                np.concatenate(file_indices),
+                                np.concatenate(link_years),
+                                np.concatenate(bands),
+                                np.concatenate(file_years))
+
+
+# Scan a directory once for its symbolic links, returning a dictionary of link names to their targets (or None if
+# there is no directory)
+def scan_symbolic_links(directory):
+    # Try to scan the directory
+    try:
+        with scandir(directory) as entries:
+            # Return the links (the entry types come from the scan, so only the links are read)
+            return {entry.name: readlink(entry.path) for entry in entries if entry.is_symlink()}
+    # If there is no directory
+    except FileNotFoundError:
+        return None
+
+
+# Relink a directory to a dictionary of its planned link names and file paths: create missing links, repoint links to
+# the wrong file (unless repoint is False, which keeps existing links), and remove links to files of the given products
+# that are not planned (links of other products are left alone). Returns the numbers of links (created, repointed,
+# removed).
+def relink_directory(directory, planned_links, products, repoint=True):
+    # Scan the existing links
+    existing_links = scan_symbolic_links(directory)
+    # If there is no directory
+    if existing_links is None:
+        # Make it
+        makedirs(directory, exist_ok=True)
+        existing_links = {}
+    # For each temporary link left by an interrupted repoint
+    for name in [name for name in existing_links.keys() if name.startswith('.') and name.endswith('.relink')]:
+        # Log the info
+        logging.info(f'Removing leftover temporary link {name} from {directory}.')
+        # Remove it (it is never planned)
+        remove(Path(directory, name))
+        del existing_links[name]
+    # Counters
+    created = 0
+    repointed = 0
+    removed = 0
+    # For each planned link
+    for name, file_path in planned_links.items():
+        # Target of the existing link (None if there is none)
+        target = existing_links.get(name)
+        # If there is no link
+        if target is None:
+            # Create it
+            symlink(file_path, Path(directory, name))
+            created += 1
+        # Otherwise, if it points to the wrong file, and links are repointed
+        elif target != file_path and repoint:
+            # Replace it with a new link (readers never see the link missing)
+            temp_path = Path(directory, f'.{name}.relink')
+            # Try to remove any temporary link already there (so the new one can be made)
+            try:
+                remove(temp_path)
+            # If there is none
+            except FileNotFoundError:
+                pass
+            symlink(file_path, temp_path)
+            replace(temp_path, Path(directory, name))
+            repointed += 1
+    # For each existing link that is not planned
+    for name in existing_links.keys() - planned_links.keys():
+        # If it is for a file of a planned product (stale)
+        if name.split('.')[0] in products:
+            # Remove it
+            remove(Path(directory, name))
+            removed += 1
+    # Return the counts
+    return created, repointed, removed
+
+
+# Relink a partition of a link plan (a target year and band): the year's three subyear directories for the band.
+# Links are only removed for the given products (none if it is empty), and only repointed if repoint is True. Returns a
+# tuple of the numbers of links (created, repointed, removed) and the seconds taken, or None if the partition failed.
+def relink_partition(partition, plan, dest_dir, partitions, products, repoint=True):
+    # Mark start time
+    stime = time()
+    # Target year and band
+    year, band = partition
+    # Get the planned links of each directory
+    directory_links = plan.get_directory_links(dest_dir, partitions.get(partition, slice(0, 0)))
+    # Counters
+    totals = [0, 0, 0]
+    # Try to relink the directories
+    try:
+        # For each year relevant to the target year
+        for subyear in range(year - 1, year + 2):
+            # Subyear directory
+            directory = Path(dest_dir, str(year), t_misc.zero_pad_number(band, digits=2), str(subyear))
+            # Relink it
+            counts = relink_directory(directory, directory_links.get(directory, {}), products, repoint=repoint)
+            # Add to the counters
+            totals = [total + count for total, count in zip(totals, counts)]
+    # If not successful
+    except OSError as e:
+        # Log the error
+        logging.error(f'Linking failed for target year {year}, band {band}: {e!r}.')
+        # Return None
+        return None
+    # Return the counts and the time taken
+    return tuple(totals), time() - stime
+
+
+# Relink the target years of a list of LAADSDataSet objects in a destination directory, scanning each of their link
+# directories once and changing only the links that differ from the plan (see relink_directory). Directories of other
+# target years are not touched. The plan is applied in partitions of (target year, band) by a pool of workers (link
+# latency on a network filesystem is per call, so concurrent partitions overlap it). Stale links are kept if
+# remove_stale is False, and existing links are kept as they are (only missing links are created) if repoint is False,
+# e.g. when several runs fill the same years from different shards. Returns a dictionary of (target year, band) to
+# ((created, repointed, removed), seconds), or None for partitions that failed.
+def relink_symbolic_links(datasets, dest_dir, target_years, workers=LINK_WORKERS, remove_stale=True, repoint=True):
+    # Plan the links
+    plan = plan_symbolic_links(datasets, target_years)
+    # Products to remove stale links for
+    products = plan.get_products() if remove_stale else set()
+    # Dictionary of the plan's partitions ((target year, band): slice of links)
+    partitions = dict(plan.get_partitions())
+    # Target bands of the datasets
+    bands = sorted({int(band) for dataset in datasets for band in get_target_bands(dataset.product)})
+    # Work for the pool: each target year and band (including those with nothing planned, so their stale links are
+    # removed)
+    work = [(year, band) for year in sorted(set(target_years)) for band in bands]
+    # Dictionary of the partition results
+    results = {}
+    # Counters
+    totals = [0, 0, 0]
+    # Mark start time
+    stime = time()
+    # For each partition as it is completed
+    for partition, result in t_misc.multithread_queue(partial(relink_partition,
+                                                              plan=plan,
+                                                              dest_dir=dest_dir,
+                                                              partitions=partitions,
+                                                              products=products,
+                                                              repoint=repoint),
+                                                      work,
+                                                      max_workers=workers):
+        # Add the result
+        results[partition] = result
+        # If it failed
+        if result is None:
+            continue
+        # Log the partition timing
+        logging.debug(f'Linked target year {partition[0]}, band {partition[1]} in {round(result[1], 2)} seconds: '
+                      f'{result[0]}.')
+        # Add to the counters
+        totals = [total + count for total, count in zip(totals, result[0])]
+    # Times of the finished partitions
+    seconds = [result[1] for result in results.values() if result]
+    # Log the info
+    logging.info(f'Relinked target years {sorted(set(target_years))} in {dest_dir} in {round(time() - stime, 2)} '
+                 f'seconds with {workers} workers ({len(seconds)} of {len(work)} partitions, slowest '
+                 f'{round(max(seconds, default=0), 2)} seconds): {totals[0]} created, {totals[1]} repointed, '
+                 f'{totals[2]} removed.')
+    # Return the results
+    return results
+
+
+# Get the path of the staging manifest for a target year and band (2-digit zero-padded band) in a directory
+def get_manifest_path(dest_dir, year, band):
+    return Path(dest_dir, f'MCD43GF_{year}_{band}.json')
+
+
+# Get the role of a data product's files in the gap-filling (e.g. D01 for MCD43D01, D31, D40)
+def get_product_role(product):
+    return product[-3:]
+
+
+# Get the content hash of a staging manifest (MD5 of its canonical JSON without the hash)
+def get_manifest_hash(manifest):
+    # Content of the manifest
+    content = {key: value for key, value in manifest.items() if key != 'Hash'}
+    # Return the hash
+    return hashlib.md5(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+# Build the staging manifest for a target year and band from a slice of a link plan: the input file paths, their dates
+# (ISO format) and product roles as parallel lists, ordered by date and role, with a content hash
+def build_staging_manifest(plan, year, band, link_slice):
+    # Dates of the files
+    dates = plan.get_dates(link_slice)
+    # Roles of the files
+    roles = np.array([get_product_role(plan.datasets[dataset_index].product)
+                      for dataset_index in plan.dataset_indices[link_slice]], dtype=str)
+    # Paths to the files
+    paths = np.array([str(file_path) for file_path, link_path in plan.get_link_paths('', link_slice)], dtype=str)
+    # Order by date, role and path
+    order = np.lexsort((paths, roles, dates))
+    # Form the manifest
+    manifest = {'Target Year': year,
+                'Band': t_misc.zero_pad_number(band, digits=2),
+                'Paths': paths[order].tolist(),
+                'Dates': [datetime.date.fromordinal(int(date)).isoformat() for date in dates[order]],
+                'Roles': roles[order].tolist()}
+    # Add the content hash
+    manifest['Hash'] = get_manifest_hash(manifest)
+    # Return the manifest
+    return manifest
+
+
+# Write a staging manifest to a path, unless the manifest there has the same hash. Returns True if it was written.
+def write_staging_manifest(manifest, manifest_path):
+    # If there is a manifest with the same content
+    if exists(manifest_path):
+        # Try to read its hash
+        try:
+            with open(manifest_path, 'r') as f:
+                if json.load(f).get('Hash') == manifest['Hash']:
+                    # Return False
+                    return False
+        # If it is not readable (it will be rewritten)
+        except (OSError, ValueError):
+            pass
+    # Write to a temporary file, then move it into place (readers never see a partial manifest)
+    temp_path = Path(f'{manifest_path}.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    replace(temp_path, manifest_path)
+    # Return True
+    return True
+
+
+# Write staging manifests for the target years of a list of LAADSDataSet objects to a directory: one per target year
+# and band, listing the input files the links would point to (an alternative to the symbolic link trees). Manifests
+# with unchanged content are not rewritten. Returns a dictionary of (target year, band) to the manifest paths.
+def write_staging_manifests(datasets, dest_dir, target_years):
+    # If the destination does not exist
+    if not exists(dest_dir):
+        # Make it
+        makedirs(dest_dir)
+    # Plan the links
+    plan = plan_symbolic_links(datasets, target_years)
+    # Dictionary of the plan's partitions ((target year, band): slice of links)
+    partitions = dict(plan.get_partitions())
+    # Target bands of the datasets
+    bands = sorted({int(band) for dataset in datasets for band in get_target_bands(dataset.product)})
+    # Dictionary of the manifest paths
+    manifest_paths = {}
+    # Counter
+    written = 0
+    # For each target year and band
+    for year in sorted(set(target_years)):
+        for band in bands:
+            # Build the manifest
+            manifest = build_staging_manifest(plan, year, band, partitions.get((year, band), slice(0, 0)))
+            # Path to the manifest
+            manifest_path = get_manifest_path(dest_dir, year, manifest['Band'])
+            # Write it (if it changed)
+            written += write_staging_manifest(manifest, manifest_path)
+            # Add the path
+            manifest_paths[(year, band)] = manifest_path
+    # Log the info
+    logging.info(f'Wrote {written} of {len(manifest_paths)} staging manifests for target years '
+                 f'{sorted(set(target_years))} to {dest_dir}.')
+    # Return the paths
+    return manifest_paths
+
+
+# Read a staging manifest (for the gap-filler's inputs), checking its content hash unless verify is False. Returns the
+# manifest with its dates as datetime date objects, or None if it is missing, not readable or does not match its hash.
+def read_staging_manifest(manifest_path, verify=True):
+    # Try to read the manifest
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    # If not successful
+    except (OSError, ValueError) as e:
+        # Log the error
+        logging.error(f'Staging manifest {manifest_path} could not be read: {e!r}.')
+        # Return None
+        return None
+    # If verifying, and the content does not match the hash
+    if verify and get_manifest_hash(manifest) != manifest.get('Hash'):
+        # Log the error
+        logging.error(f'Staging manifest {manifest_path} does not match its hash.')
+        # Return None
+        return None
+    # Convert the dates
+    manifest['Dates'] = [datetime.date.fromisoformat(date) for date in manifest['Dates']]
+    # Return the manifest
+    return manifest
+
+
+# Takes a LAADSDataSet object and a destination directory (and optionally a list of the target years to link;
+# otherwise every "middle" year between the bookend years of the dataset). Missing links are created by a pool of
+# workers (see relink_symbolic_links); with relink, wrong links are also repointed and stale links removed.
+def create_symbolic_links(dataset, dest_dir, target_years=None, relink=False, workers=LINK_WORKERS):
     # Get the sorted list of years from the dataset
     years = sorted(dataset.by_year_doy.keys(), key=int)
     # We assume that the first and last years in the dataset bookend the years to be processed.
-    # Construct start date
-    start_date = datetime.date(year=int(years[0]),
-                               month=6,
-                               day=20)
-    # Construct end date
-    end_date = datetime.date(year=int(years[-1]),
-                             month=1,
-                             day=1) + datetime.timedelta(days=192)
+    # If no target years were provided
+    if target_years is None:
+        # Use each "middle" year between the bookend years (the year after the first, to the year before the last)
+        target_years = list(range(int(years[0]) + 1, int(years[-1])))
     # Check destination is a path
     if not isinstance(dest_dir, Path):
         # Try converting to a path
@@ -37,66 +588,5 @@ def create_symbolic_links(dataset, dest_dir):
     if not exists(dest_dir):
         # Make it
         mkdir(dest_dir)
-    # Target directories for symbolic links
-    target_bands = []
-    # If the data product name is MCD43D31 or MCD43D40 (which are used by every band)
-    if dataset.product == "MCD43D31" or dataset.product == "MCD43D40":
-        # The target bands will be all bands
-        target_bands = ['01', '02', '03', '04', '05', '06', '07']
-    else:
-        # Get the band directory name (2-digit zero-padded band)
-        target_bands.append(t_misc.zero_pad_number(round((int(dataset.product[-2:]) + 1) / 3), digits=2))
-    # For each "middle" year between the bookend years <>
-    for year in list(range(start_date.year + 1, end_date.year)):
-        # Year directory
-        year_dir = Path(dest_dir, str(year))
-        # If there is not a directory yet
-        if not exists(year_dir):
-            # Make it
-            mkdir(year_dir)
-        # For each target band
-        for band in target_bands:
-            # Band dir
-            band_dir = Path(year_dir, band)
-            # If there is not a directory yet
-            if not exists(band_dir):
-                # Make it
-                mkdir(band_dir)
-            # For each year relevant to this middle year
-            for subyear in list(range(year - 1, year + 2)):
-                # Subyear directory
-                subyear_dir = Path(band_dir, str(subyear))
-                # If there is not a directory yet
-                if not exists(subyear_dir):
-                    # Make it
-                    mkdir(subyear_dir)
-    # For each date_key in the dataset
-    for date_key in dataset.by_date.keys():
-        # If the date is in the overall window to be used
-        if start_date <= date_key <= end_date:
-            # For each target band
-            for band in target_bands:
-                # For each "middle" year between the bookend years
-                for year in list(range(start_date.year + 1, end_date.year)):
-                    # Construct start date
-                    curr_start = datetime.date(year=year - 1,
-                                               month=6,
-                                               day=20)
-                    # Construct end date
-                    curr_end = datetime.date(year=year + 1,
-                                             month=1,
-                                             day=1) + datetime.timedelta(days=192)
-                    # If the date is in the current window
-                    if curr_start <= date_key <= curr_end:
-                        # For each file in the date
-                        for file in dataset.by_date[date_key]:
-                            # Current file name
-                            filename = file.name
-                            # Path to the file
-                            file_path = Path(environ['inputs_dir'], dataset.name, filename)
-                            # Get the link path
-                            link_path = Path(dest_dir, str(year), band, str(date_key.year), filename)
-                            # If the link does not already exist
-                            if not exists(link_path):
-                                # Create a symbolic link
-                                symlink(file_path, link_path)
+    # Create the links of the target years (in the relink mode, also repointing wrong links and removing stale links)
+    relink_symbolic_links([dataset], dest_dir, target_years, workers=workers, remove_stale=relink, repoint=relink)
@@ -1,6 +1,8 @@
 import datetime
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
 from pathlib import Path
 from os.path import exists
 from os import mkdir
@@ -40,6 +42,115 @@ def multithread(mt_func, list_of_work, as_completed_func=None, as_completed_yiel
                 yield future
 
 
+# Multithread levels of work as a pipeline, where each completed item can immediately feed new work.
+# expand_func(level, work, result) returns a list of (level, work) tuples. Yields (level, work, result) as completed.
+def multithread_pipeline(mt_func, initial_work, expand_func, level_workers, max_queued=10000):
+    # Queue of pending work for each level (in the order of the levels)
+    queues = {level: deque() for level in level_workers.keys()}
+    # Add the initial work
+    for level, work in initial_work:
+        queues[level].append(work)
+    # Work in flight for each level
+    in_flight = {level: 0 for level in level_workers.keys()}
+    # Dictionary of futures to their level and work
+    futures = {}
+    # Instantiate thread pool (one thread per allowed request across all levels)
+    with ThreadPoolExecutor(max_workers=sum(level_workers.values())) as executor:
+        # While there is work in flight or queued
+        while True:
+            # Total queued work
+            queued = sum(len(queue) for queue in queues.values())
+            # For each level, deepest first
+            for level in reversed(list(queues.keys())):
+                # If the queue is over its bound, only work that cannot feed more work is started
+                if queued > max_queued and level != list(queues.keys())[-1]:
+                    continue
+                # While there is work and the level has capacity
+                while queues[level] and in_flight[level] < level_workers[level]:
+                    # Submit the next work
+                    work = queues[level].popleft()
+                    futures[executor.submit(mt_func, work)] = (level, work)
+                    in_flight[level] += 1
+            # If nothing is in flight
+            if not futures:
+                # Finished
+                break
+            # Wait for at least one future to complete
+            done, not_done = wait(futures.keys(), return_when=FIRST_COMPLETED)
+            # For each completed future
+            for future in done:
+                # Get its level and work
+                level, work = futures.pop(future)
+                in_flight[level] -= 1
+                # Queue any new work
+                for new_level, new_work in expand_func(level, work, future.result()):
+                    queues[new_level].append(new_work)
+                # Yield the result
+                yield level, work, future.result()
+
+
+# Multithread a function over an iterable of work with a persistent pool of workers fed from a bounded queue:
+# each worker takes the next work as soon as it finishes, and at most max_in_flight pieces of work are submitted
+# at once (so the iterable is consumed lazily). Yields (work, result) tuples as completed.
+def multithread_queue(mt_func, work_iter, max_workers=5, max_in_flight=None):
+    # If there is no in-flight limit
+    if not max_in_flight:
+        # Keep every worker busy, with one more piece of work each ready to go
+        max_in_flight = max_workers * 2
+    # Iterator over the work
+    work_iter = iter(work_iter)
+    # Dictionary of futures to their work
+    futures = {}
+    # Instantiate thread pool
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # While there is work
+        while True:
+            # While there is room in flight
+            while len(futures) < max_in_flight:
+                # Get the next work (or stop topping up if there is none)
+                work = next(work_iter, None)
+                if work is None:
+                    break
+                # Submit it
+                futures[executor.submit(mt_func, work)] = work
+            # If nothing is in flight
+            if not futures:
+                # Finished
+                break
+            # Wait for at least one future to complete
+            done, not_done = wait(futures.keys(), return_when=FIRST_COMPLETED)
+            # For each completed future
+            for future in done:
+                # Yield the work and its result
+                yield futures.pop(future), future.result()
+
+
+# Default chunk size for hashing files (bytes)
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+# Get the MD5 hash of a file in storage, reading it in bounded chunks into a reused buffer
+def get_file_md5(file_path, chunk_size=HASH_CHUNK_SIZE):
+    # Incremental hash
+    file_hash = hashlib.md5()
+    # Buffer for the chunks (and a view, so slices are not copied)
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    # Open the file without buffering (reads go straight into the buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        # While there are bytes to read
+        while True:
+            # Read a chunk
+            n_bytes = f.readinto(buffer)
+            # If the file has ended
+            if not n_bytes:
+                break
+            # Hash the chunk
+            file_hash.update(view[:n_bytes])
+    # Return the hash
+    return file_hash.hexdigest()
+
+
 # Get a DOY from a datetime object (specify zero pad digits in zero_pad kwarg)
 def get_doy_from_date(date, zero_pad_digits=None):
     # Get the day of year
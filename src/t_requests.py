@@ -1,10 +1,36 @@
 import logging
-import h5py
 import t_misc
+import c_aimd_limiter
+import c_retry_policy
 import hashlib
-from io import BytesIO
-from time import sleep
-from requests.exceptions import JSONDecodeError
+import json
+from os import remove, replace
+from os.path import exists
+from pathlib import Path
+from time import sleep, monotonic
+from requests.exceptions import JSONDecodeError, RequestException
+
+
+# Default chunk size for streaming content to storage (bytes)
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+# Wait while the circuit for a URL's host is open in a retry policy (up to its max_circuit_wait), so queued requests
+# wait out an outage instead of failing. Returns True once a request is allowed, or False if the wait ran out.
+def wait_for_circuit(retry_policy, url):
+    # Seconds waited
+    waited = 0
+    # While the circuit does not allow the request
+    while not retry_policy.allow_request(url):
+        # If the wait ran out
+        if waited >= retry_policy.max_circuit_wait:
+            return False
+        # Wait before checking again (at least a moment, in case another request took the trial)
+        wait = max(0.1, retry_policy.get_circuit_wait(url))
+        sleep(wait)
+        waited += wait
+    # Return True
+    return True
 
 
 # Ask nicely for a particular URL from a requests module session object
@@ -14,6 +40,13 @@ def ask_nicely(session,
                validation_func=None,
                hash_func=None,
                hash_to_check=None,
+               headers=None,
+               headers_func=None,
+               ok_codes=(200,),
+               stream=False,
+               limiter=None,
+               rate_limiter=None,
+               retry_policy=None,
                back_off_base=0,
                back_off_inc=1,
                attempts_per_session=3,
@@ -22,22 +55,43 @@ def ask_nicely(session,
     attempts = 0
     # Attempts left in session
     session_attempts = attempts_per_session
+    # Seconds the server asked us to wait before retrying (Retry-After), if any
+    retry_after = None
     # While attempts continue
     while True:
         # Increment attempts
         attempts += 1
-        # If this is not the first attempt
-        if attempts > 1:
-            # Add to the back-off timer
-            back_off_base += back_off_inc
-            # Wait quietly and politely
-            sleep(back_off_base)
         # If attempt max has been reached
         if attempts == max_attempts + 1:
             # Log max attempts
             logging.error(f'Request for {url} reached maximum attempts ({max_attempts}).')
             # Break the loop
             break
+        # If this is not the first attempt
+        if attempts > 1:
+            # If there is a retry policy
+            if retry_policy:
+                # If the retry budget for the run is spent
+                if not retry_policy.take_retry():
+                    # Log the info
+                    logging.info(f'Request for {url} not retried (retry budget spent).')
+                    # Break the loop
+                    break
+                # Wait for the policy's delay (exponential with full jitter, or the server's Retry-After)
+                sleep(retry_policy.get_delay(attempts - 1, retry_after))
+                retry_after = None
+            # Otherwise
+            else:
+                # Add to the back-off timer
+                back_off_base += back_off_inc
+                # Wait quietly and politely
+                sleep(back_off_base)
+        # If there is a retry policy, and the host's circuit stayed open for too long
+        if retry_policy and not wait_for_circuit(retry_policy, url):
+            # Log the info
+            logging.info(f'Request for {url} not made (circuit open for the host).')
+            # Break the loop
+            break
         # Decrement remaining attempts for session
         session_attempts -= 1
         # If session attempts has reached 0
@@ -60,52 +114,126 @@ def ask_nicely(session,
                     f'No function to get new session (session_func) was supplied.')
                 # Break the loop
                 break
-        # Make a request
-        r = session.get(url, allow_redirects=False)
-        # If the request does not have a success code (code 200)
-        if r.status_code != 200:
-            # Log a non-200 status code
-            logging.info(f'Request for {url}, attempt {attempts} returned code: {r.status_code}.')
-            # Move to next attempt
-            continue
-        # If there is a hash function
-        if hash_func:
-            # If a hash was provided to check against
-            if hash_to_check:
-                # Check the hash with the validation function
-                r = hash_func(r, hash_to_check)
-                # If the response failed the hash match
-                if not r:
-                    # Log a hash match failure
-                    logging.info(f'Request for {url} did not match hash.')
+        # Headers for this attempt
+        attempt_headers = headers
+        # If there is a function for per-attempt headers (e.g. a Range to resume a partial download)
+        if headers_func:
+            # Add its headers to any fixed headers
+            attempt_headers = dict(headers if headers else {}, **headers_func())
+        # If there is a rate limiter (shared by every process on the host), wait for a turn
+        if rate_limiter:
+            rate_limiter.acquire()
+        # If there is a concurrency limiter, wait for a slot (held only while the request is in flight)
+        start_time = limiter.acquire() if limiter else None
+        # Whether the server wants us to slow down, whether the attempt succeeded, the bytes received, and the latency
+        # to the response headers (before any streamed body is read)
+        back_off = False
+        succeeded = False
+        n_bytes = 0
+        latency = None
+        try:
+            # Try to make a request
+            try:
+                r = session.get(url, allow_redirects=False, headers=attempt_headers, stream=stream)
+                # If there is a concurrency limiter, measure the latency to the response headers
+                if limiter:
+                    latency = monotonic() - start_time
+            # If the request failed outright (e.g. the connection was refused or reset)
+            except RequestException as e:
+                # Log the error
+                logging.info(f'Request for {url}, attempt {attempts} raised {e!r}.')
+                # Ask the limiter to back off
+                back_off = True
+                # If there is a retry policy
+                if retry_policy:
+                    # Record the failure of the host
+                    retry_policy.record_failure(url)
+                # Move to next attempt
+                continue
+            # If the request does not have a success code (code 200, or others accepted e.g. 304 Not Modified)
+            if r.status_code not in ok_codes:
+                # Log a non-200 status code
+                logging.info(f'Request for {url}, attempt {attempts} returned code: {r.status_code}.')
+                # If the server wants us to slow down, ask the limiter to back off
+                back_off = r.status_code in c_aimd_limiter.BACK_OFF_CODES
+                # Release the connection
+                r.close()
+                # If there is a retry policy
+                if retry_policy:
+                    # If the host failed
+                    if r.status_code in c_retry_policy.HOST_FAILURE_CODES:
+                        # Record the failure
+                        retry_policy.record_failure(url)
+                    # If the code will not change on a retry
+                    if not retry_policy.should_retry(r.status_code):
+                        # Log the info
+                        logging.info(f'Request for {url} not retried (code {r.status_code}).')
+                        # Break the loop
+                        break
+                    # Get any Retry-After from the server
+                    retry_after = retry_policy.get_retry_after(r.status_code, r.headers)
+                # Move to next attempt
+                continue
+            # If there is a retry policy
+            if retry_policy:
+                # Record the success of the host
+                retry_policy.record_success(url)
+            # Bytes in the response
+            n_bytes = int(r.headers.get('Content-Length', 0))
+            # If the request was accepted without content to check (204 No Content, 304 Not Modified)
+            if r.status_code in (204, 304):
+                # Return the response
+                succeeded = True
+                return r
+            # If there is a hash function
+            if hash_func:
+                # If a hash was provided to check against
+                if hash_to_check:
+                    # Check the hash with the validation function
+                    r = hash_func(r, hash_to_check)
+                    # If the response failed the hash match
+                    if not r:
+                        # Log a hash match failure
+                        logging.info(f'Request for {url} did not match hash.')
+                        # Go to the next attempt
+                        continue
+                # Otherwise (no hash provided)
+                else:
+                    # Log a warning
+                    logging.info(f'Hash validation function provided for {url}, but no reference hash provided.')
+            # If there is a validation function
+            if validation_func:
+                # Listify the validation function
+                validation_func = t_misc.listify(validation_func)
+                # Validation trigger
+                valid_file = True
+                # For each validation function
+                for v_func in validation_func:
+                    # Get the response wanted from the validation function
+                    r = v_func(r)
+                    # If the response failed the validation function
+                    if not r:
+                        # Flip the valid switch
+                        valid_file = False
+                        # Log a validation failure
+                        logging.info(f'Request for {url} failed validation by {v_func}.')
+                # If file was not valid
+                if not valid_file:
                     # Go to the next attempt
                     continue
-            # Otherwise (no hash provided)
-            else:
-                # Log a warning
-                logging.info(f'Hash validation function provided for {url}, but no reference hash provided.')
-        # If there is a validation function
-        if validation_func:
-            # Listify the validation function
-            validation_func = t_misc.listify(validation_func)
-            # Validation trigger
-            valid_file = True
-            # For each validation function
-            for v_func in validation_func:
-                # Get the response wanted from the validation function
-                r = v_func(r)
-                # If the response failed the validation function
-                if not r:
-                    # Flip the valid switch
-                    valid_file = False
-                    # Log a validation failure
-                    logging.info(f'Request for {url} failed validation by {v_func}.')
-            # If file was not valid
-            if not valid_file:
-                # Go to the next attempt
-                continue
-        # Return the response
-        return r
+            # Return the response
+            succeeded = True
+            return r
+        # Once the attempt is over
+        finally:
+            # If there is a concurrency limiter
+            if limiter:
+                # Release the slot, recording the outcome
+                limiter.release(start_time, back_off=back_off, succeeded=succeeded, n_bytes=n_bytes, latency=latency)
+            # If there is a rate limiter
+            if rate_limiter:
+                # Take the bytes received
+                rate_limiter.consume_bytes(n_bytes)
     # Log max attempts
     logging.error(f'Request for {url} failed completely.')
     # Return None
@@ -129,22 +257,254 @@ def validate_request_json(r):
         return r
 
 
-# Validate a request contents as hdf5
-def validate_request_hdf5(r):
-    # Try to parse the response into HDF5
+# Validate a request contents as json, keeping the response (e.g. for its headers)
+def validate_request_json_response(r):
+    # If the contents are not valid json
+    if validate_request_json(r) is None:
+        # Return None
+        return None
+    # Return the response
+    return r
+
+
+# Get the path of the partial (temporary) file for a write path
+def get_partial_path(write_path):
+    return Path(str(write_path) + '.tmp')
+
+
+# Get the path of the sidecar recording the progress of a partial file
+def get_partial_sidecar_path(write_path):
+    return Path(str(write_path) + '.tmp.json')
+
+
+# Record the progress of a partial file (received length and the hash of that prefix) in its sidecar
+def put_partial_sidecar(write_path, hash_to_check, length, prefix_hash):
+    # Sidecar path
+    sidecar_path = get_partial_sidecar_path(write_path)
+    # Write to a temporary sidecar first
+    with open(str(sidecar_path) + '.tmp', 'w') as f:
+        json.dump({'Hash': hash_to_check, 'Length': length, 'Prefix Hash': prefix_hash}, f)
+    # Atomically move the sidecar into place (so it is never half written)
+    replace(str(sidecar_path) + '.tmp', sidecar_path)
+
+
+# Get the sidecar of a partial file for a write path as a dictionary (or None if there is no usable partial)
+def get_partial_sidecar(write_path, hash_to_check=None):
+    # Try to read the sidecar
     try:
-        test_convert = h5py.File(BytesIO(r.content), 'r')
-    # If not successful
-    except OSError:
+        with open(get_partial_sidecar_path(write_path), 'r') as f:
+            sidecar = json.load(f)
+    # If there is no sidecar, or it is not readable
+    except (OSError, ValueError):
+        # Return None
+        return None
+    # If the partial was for a different version of the file (different reference hash)
+    if sidecar.get('Hash') != hash_to_check:
+        # Return None
+        return None
+    # If the partial file is missing, or shorter than the recorded length
+    if not exists(get_partial_path(write_path)) or \
+            get_partial_path(write_path).stat().st_size < sidecar.get('Length', 0):
+        # Return None
+        return None
+    # Return the sidecar
+    return sidecar
+
+
+# Get the headers to resume a partial download for a write path (empty if there is no usable partial)
+def get_resume_headers(write_path, hash_to_check=None):
+    # Get the sidecar
+    sidecar = get_partial_sidecar(write_path, hash_to_check=hash_to_check)
+    # If there is no usable partial, or it is empty
+    if not sidecar or not sidecar['Length']:
+        # No headers
+        return {}
+    # Ask for the rest of the file
+    return {'Range': f'bytes={sidecar["Length"]}-'}
+
+
+# Load a partial file for resuming, re-hashing its prefix from storage (the hash state can not be saved).
+# Returns a tuple of (length, hash object), or None if the partial is not usable.
+def load_partial(write_path, hash_to_check=None, chunk_size=STREAM_CHUNK_SIZE):
+    # Get the sidecar
+    sidecar = get_partial_sidecar(write_path, hash_to_check=hash_to_check)
+    # If there is no usable partial
+    if not sidecar:
+        # Return None
+        return None
+    # Incremental hash
+    prefix_hash = hashlib.md5()
+    # Bytes left to hash
+    remaining = sidecar['Length']
+    # Hash the recorded prefix of the partial file
+    with open(get_partial_path(write_path), 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            # If the file ended early
+            if not chunk:
+                break
+            prefix_hash.update(chunk)
+            remaining -= len(chunk)
+    # If the prefix does not match the recorded hash
+    if remaining or prefix_hash.hexdigest() != sidecar['Prefix Hash']:
         # Log the occurrence
-        logging.debug(f'Response content was not a valid HDF5.')
+        logging.info(f'Partial file for {write_path} did not match its sidecar. Discarding.')
         # Return None
         return None
-    # Otherwise (HDF5 encoded)
-    else:
+    # Return the length and the hash object
+    return sidecar['Length'], prefix_hash
+
+
+# Get the start byte of a partial content (206) response from its Content-Range header (or None)
+def get_content_range_start(r):
+    # Try to parse the header (e.g. "bytes 1048576-5242879/5242880")
+    try:
+        return int(r.headers['Content-Range'].split(' ')[1].split('-')[0])
+    # If it is missing or not parsable
+    except (KeyError, IndexError, ValueError):
+        # Return None
+        return None
+
+
+# Get a validation function (for ask_nicely with stream=True) that streams a response's content to a temporary file,
+# hashing it as it arrives, then atomically renames it to write_path only if it matches the reference hash and
+# passes any file validation functions (which take a path and return it, or None).
+# If the transfer is interrupted, the partial file is kept, with a sidecar of its received length and the hash of
+# that prefix (updated every checkpoint_chunks chunks), so a partial content (206) response to a Range request
+# (see get_resume_headers) carries on from where it stopped.
+def get_stream_to_file_func(write_path,
+                            hash_to_check=None,
+                            file_validation_func=None,
+                            chunk_size=STREAM_CHUNK_SIZE,
+                            checkpoint_chunks=16):
+
+    # Stream a response to storage
+    def stream_to_file(r):
+        # Ensure the path, but if it returns False (failed)
+        if not t_misc.ensure_file_path_dirs_exist(Path(write_path)):
+            # Log an error
+            logging.error(f'Could not ensure write path for {write_path}.')
+            # Return None
+            return None
+        # Temporary path in the same directory (so the rename is atomic)
+        temp_path = get_partial_path(write_path)
+        # If the server could not satisfy the Range (the partial is not usable)
+        if r.status_code == 416:
+            # Log the occurrence
+            logging.info(f'Range for {r.url} was not satisfiable. Discarding partial file.')
+            # Remove the partial file and return None (the next attempt starts from scratch)
+            return remove_partial_file(write_path)
+        # Bytes received (and the hash of them)
+        length = 0
+        file_hash = hashlib.md5()
+        # Write mode (from scratch)
+        mode = 'wb'
+        # If this is the rest of a partial file
+        if r.status_code == 206:
+            # Load the partial file
+            partial = load_partial(write_path, hash_to_check=hash_to_check, chunk_size=chunk_size)
+            # If it is not usable, or the response does not start where it stopped
+            if not partial or get_content_range_start(r) != partial[0]:
+                # Log the occurrence
+                logging.info(f'Partial content for {r.url} did not match the partial file. Discarding.')
+                # Release the connection
+                r.close()
+                # Remove the partial file and return None (the next attempt starts from scratch)
+                return remove_partial_file(write_path)
+            # Carry on from the partial file
+            length, file_hash = partial
+            mode = 'r+b'
+            # Log the info
+            logging.info(f'Resuming {r.url} from byte {length}.')
+        # Byte the response starts at
+        start = length
+        # Try to stream the content
+        try:
+            with open(temp_path, mode) as f:
+                # Move to the end of the received bytes, dropping anything past them (e.g. after a kill)
+                f.seek(length)
+                f.truncate()
+                # For each chunk as it arrives
+                for chunk_number, chunk in enumerate(r.iter_content(chunk_size=chunk_size), 1):
+                    # Write and hash it
+                    f.write(chunk)
+                    file_hash.update(chunk)
+                    length += len(chunk)
+                    # If this is a checkpoint
+                    if chunk_number % checkpoint_chunks == 0:
+                        # Make sure the bytes are written before they are recorded
+                        f.flush()
+                        # Record the progress
+                        put_partial_sidecar(write_path, hash_to_check, length, file_hash.copy().hexdigest())
+        # If the transfer or the write failed
+        except (OSError, RequestException) as e:
+            # Log the occurrence
+            logging.info(f'Streaming {r.url} to {temp_path} failed at byte {length}: {e!r}.')
+            # Try to record the progress, so the next attempt (or run) can resume
+            try:
+                put_partial_sidecar(write_path, hash_to_check, length, file_hash.hexdigest())
+            # If it could not be recorded
+            except OSError:
+                # Remove the partial file
+                remove_partial_file(write_path)
+            # Return None
+            return None
+        # If the response ended before its stated length (the connection closed early without an error)
+        if 'Content-Length' in r.headers and length - start < int(r.headers['Content-Length']):
+            # Log the occurrence
+            logging.info(f'Streaming {r.url} to {temp_path} ended early at byte {length}.')
+            # Record the progress, so the next attempt (or run) can resume
+            put_partial_sidecar(write_path, hash_to_check, length, file_hash.hexdigest())
+            # Return None
+            return None
+        # If the hashes don't match
+        if hash_to_check and file_hash.hexdigest() != hash_to_check:
+            # Log the hash mismatch
+            logging.info('Response content did not match the reference hash.')
+            # Remove the partial file and return None
+            return remove_partial_file(write_path)
+        # For each file validation function
+        for v_func in t_misc.listify(file_validation_func):
+            # If the file failed the validation function
+            if not v_func(temp_path):
+                # Log a validation failure
+                logging.info(f'{temp_path} failed validation by {v_func}.')
+                # Remove the partial file and return None
+                return remove_partial_file(write_path)
+        # If there is already a file at the write path
+        if exists(write_path):
+            # Log a warning
+            logging.warning(f'Already a file at {write_path}. Overwriting.')
+        # Atomically move the file into place
+        replace(temp_path, write_path)
+        # Remove the sidecar
+        remove_temp_file(get_partial_sidecar_path(write_path))
+        # Log the info
+        logging.info(f'Successfully wrote object to {write_path}.')
         # Return the response
         return r
 
+    # Return the function
+    return stream_to_file
+
+
+# Remove a partial file and its sidecar for a write path, returning None
+def remove_partial_file(write_path):
+    # Remove the sidecar first (so the partial is never resumed without it)
+    remove_temp_file(get_partial_sidecar_path(write_path))
+    # Remove the partial file
+    return remove_temp_file(get_partial_path(write_path))
+
+
+# Remove a temporary file (if it exists), returning None
+def remove_temp_file(temp_path):
+    # If the file exists
+    if exists(temp_path):
+        # Remove it
+        remove(temp_path)
+    # Return None
+    return None
+
 
 # Validate MD5 hash for a file
 def validate_request_md5(r, ref_hash):